@@ -7,11 +7,30 @@ import time
 import uuid
 import threading
 import asyncio
+import base64
+import binascii
+import concurrent.futures
+import contextlib
+import hashlib
+import heapq
+import math
+import mimetypes
 import os
+import queue
+import re
 import sys
+import urllib.parse
+import urllib.request
 from playwright.async_api import async_playwright
+import zlib
 import logging
 import atexit
+from collections import OrderedDict, deque
+
+try:
+    import brotli  # Optional, only needed for br response compression
+except ImportError:
+    brotli = None
 
 # --- Async Runner ---
 class AsyncAutomationRunner:
@@ -33,53 +52,401 @@ class AsyncAutomationRunner:
         future = asyncio.run_coroutine_threadsafe(coro, self.loop)
         return future.result()
 
+    def submit_coroutine(self, coro):
+        """Start a coroutine in the event loop without waiting, returning a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
 automation_runner = AsyncAutomationRunner()
 
 
 # --- Configuration Loading ---
-def load_config():
-    """Load configuration from config.json file"""
+class ConfigError(Exception):
+    """Raised when a config file is missing, unreadable or invalid"""
+    pass
+
+def get_config_path():
+    """Path of config.json, next to the executable or the script"""
     # Check if running as PyInstaller executable
     if getattr(sys, 'frozen', False):
         # Running as executable - look for config.json next to the executable
-        config_path = os.path.join(os.path.dirname(sys.executable), 'config.json')
-    else:
-        # Running as script - look for config.json next to the script
-        config_path = os.path.join(os.path.dirname(__file__), 'config.json')
-    
+        return os.path.join(os.path.dirname(sys.executable), 'config.json')
+    # Running as script - look for config.json next to the script
+    return os.path.join(os.path.dirname(__file__), 'config.json')
+
+def read_config(config_path):
+    """Read and validate a config file, raising ConfigError if it can't be used"""
     try:
         with open(config_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+            new_config = json.load(f)
     except FileNotFoundError:
-        print(f"Error: config.json not found at {config_path}")
-        print("Please ensure config.json exists in the same directory as this script.")
-        exit(1)
+        raise ConfigError(f"config.json not found at {config_path}")
     except json.JSONDecodeError as e:
-        print(f"Error: Invalid JSON in config.json: {e}")
+        raise ConfigError(f"Invalid JSON in config.json: {e}")
+    validate_config(new_config)
+    return new_config
+
+def load_config():
+    """Load configuration from config.json file"""
+    config_path = get_config_path()
+    try:
+        return read_config(config_path)
+    except ConfigError as e:
+        print(f"Error: {e}")
+        if not os.path.exists(config_path):
+            print("Please ensure config.json exists in the same directory as this script.")
         exit(1)
 
+NUMBER = (int, float)
+
+# Settings every config needs, and their types
+REQUIRED_CONFIG = {
+    'server': {'host': str, 'port': int, 'secret_key': str},
+    'browser': {'headless_mode': bool, 'visual_debug_mode': bool, 'data_dir': str},
+    'hover_config': {'offset_x': NUMBER, 'offset_y': NUMBER},
+    'files': {'transformed_request_file': str},
+    'urls': {'drive_folder_url': str, 'aistudio_url': str},
+    'gemini': {'model': str, 'temperature': NUMBER, 'top_p': NUMBER, 'top_k': int, 'max_output_tokens': int,
+               'response_mime_type': str, 'enable_code_execution': bool, 'enable_search_as_tool': bool,
+               'enable_browse_as_tool': bool, 'enable_auto_function_response': bool, 'thinking_budget': int},
+    'timeouts': {'max_wait_start': NUMBER, 'max_wait_complete': NUMBER, 'additional_wait': NUMBER,
+                 'before_run_button_click': NUMBER},
+}
+
+def validate_config(new_config):
+    """Check that all required settings are present with the right types"""
+    errors = []
+    for section, keys in REQUIRED_CONFIG.items():
+        values = new_config.get(section)
+        if not isinstance(values, dict):
+            errors.append(f"missing section '{section}'")
+            continue
+        for key, expected_type in keys.items():
+            value = values.get(key)
+            # bool is a subclass of int, so don't let true/false pass as numbers
+            wrong_bool = isinstance(value, bool) and expected_type is not bool
+            if key not in values or wrong_bool or not isinstance(value, expected_type):
+                errors.append(f"'{section}.{key}' is missing or has the wrong type")
+    pipeline = new_config.get('pipeline', {})
+    extra_slots = pipeline.get('extra_slots', []) if isinstance(pipeline, dict) else None
+    if not isinstance(extra_slots, list):
+        errors.append("'pipeline.extra_slots' must be a list")
+    else:
+        for i, slot in enumerate(extra_slots):
+            if not isinstance(slot, dict) or not all(isinstance(slot.get(key), str) and slot[key]
+                                                     for key in ('transformed_request_file', 'aistudio_url')):
+                errors.append(f"'pipeline.extra_slots[{i}]' needs a transformed_request_file and an aistudio_url")
+    if errors:
+        raise ConfigError("Invalid config.json: " + "; ".join(errors))
+
+def apply_config(new_config):
+    """Swap in a new configuration. Values read per request take effect from the next request."""
+    global config, HEADLESS_MODE, VISUAL_DEBUG_MODE, BROWSER_DATA_DIR, HOVER_OFFSET_X, HOVER_OFFSET_Y
+    global TRANSFORMED_REQUEST_FILE, DRIVE_FOLDER_URL, AISTUDIO_URL, ADAPTIVE_TIMEOUTS
+
+    HEADLESS_MODE = new_config['browser']['headless_mode']
+    VISUAL_DEBUG_MODE = new_config['browser']['visual_debug_mode']
+    BROWSER_DATA_DIR = new_config['browser']['data_dir']
+
+    HOVER_OFFSET_X = new_config['hover_config']['offset_x']
+    HOVER_OFFSET_Y = new_config['hover_config']['offset_y']
+
+    TRANSFORMED_REQUEST_FILE = new_config['files']['transformed_request_file']
+
+    DRIVE_FOLDER_URL = new_config['urls']['drive_folder_url']
+    AISTUDIO_URL = new_config['urls']['aistudio_url']
+
+    ADAPTIVE_TIMEOUTS = new_config.get('adaptive_timeouts', {})
+
+    config = new_config
+
 # Load configuration
-config = load_config()
+apply_config(load_config())
 
-# Extract configuration values
+# Extract configuration values (these need a restart to change)
 HOST = config['server']['host']
 PORT = config['server']['port']
 SECRET_KEY = config['server']['secret_key']
 
-HEADLESS_MODE = config['browser']['headless_mode']
-VISUAL_DEBUG_MODE = config['browser']['visual_debug_mode']
-BROWSER_DATA_DIR = config['browser']['data_dir']
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-HOVER_OFFSET_X = config['hover_config']['offset_x']
-HOVER_OFFSET_Y = config['hover_config']['offset_y']
+# --- Request Deadlines ---
+class DeadlineExceeded(Exception):
+    """Raised when a request can no longer finish before its deadline"""
+    pass
 
-TRANSFORMED_REQUEST_FILE = config['files']['transformed_request_file']
+# Rough minimum time each automation stage needs (mostly the fixed sleeps inside each stage)
+AUTOMATION_STAGES = ('upload', 'run', 'copy')
+STAGE_MIN_SECONDS = {'upload': 12, 'run': 8, 'copy': 10}
 
-DRIVE_FOLDER_URL = config['urls']['drive_folder_url']
-AISTUDIO_URL = config['urls']['aistudio_url']
+class Deadline:
+    """Time budget a client gave a single request. A deadline without seconds never expires."""
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds if seconds else None
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    def remaining(self):
+        """Seconds left before the deadline, or None if there is no deadline"""
+        if self.expires_at is None:
+            return None
+        return self.expires_at - time.monotonic()
+
+    def expired(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def can_fit(self, extra_seconds=0):
+        """Check if a full upload, run and copy cycle (plus extra_seconds) still fits in the budget"""
+        remaining = self.remaining()
+        return remaining is None or remaining - extra_seconds >= sum(STAGE_MIN_SECONDS.values())
+
+    def budget_for(self, stage):
+        """Time the given stage may use, keeping enough in reserve for the stages after it"""
+        remaining = self.remaining()
+        if remaining is None:
+            return None
+        later_stages = AUTOMATION_STAGES[AUTOMATION_STAGES.index(stage) + 1:]
+        budget = remaining - sum(STAGE_MIN_SECONDS[s] for s in later_stages)
+        if budget < STAGE_MIN_SECONDS[stage]:
+            raise DeadlineExceeded(f"Not enough time left for the {stage} stage ({max(remaining, 0):.1f}s remaining)")
+        return budget
+
+def get_request_deadline(request_data):
+    """Build a request's deadline from the X-Request-Timeout header, the OpenAI timeout field, or the config default"""
+    timeout = request.headers.get('X-Request-Timeout')
+    if timeout is None:
+        timeout = request_data.get('timeout')
+    if timeout is None:
+        timeout = config['timeouts'].get('default_request_timeout')
+    if timeout is None:
+        return Deadline()
+    timeout = float(timeout)
+    if not math.isfinite(timeout) or timeout <= 0:
+        raise ValueError("timeout must be a positive number of seconds")
+    return Deadline(timeout)
+
+# --- Quota Detection ---
+class QuotaExceeded(Exception):
+    """Raised when AI Studio reports a quota or rate limit, or its circuit breaker is open"""
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class AIStudioError(Exception):
+    """Raised when AI Studio shows an error message instead of a response"""
+    pass
+
+# Where AI Studio shows errors (snackbars, toasts, alerts) and how to tell quota errors apart
+PAGE_ERROR_SELECTOR = 'ms-toast, .mat-mdc-snack-bar-label, .mat-snack-bar-container, [role="alert"], .model-error'
+QUOTA_ERROR_PATTERN = re.compile(r"quota|rate.?limit|resource.?exhausted|too many requests", re.IGNORECASE)
+PAGE_ERROR_PATTERN = re.compile(r"error|failed|something went wrong|try again", re.IGNORECASE)
+
+class CircuitBreaker:
+    """Stops sending requests to an account (or prompt slot) that hit a quota, until a cooldown passes.
+
+    Closed: requests go through. Open: requests fail fast with a 429. Once the cooldown is over one
+    trial request is let through (half open). If it hits the quota again the cooldown doubles."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = {}  # key -> {"open_until", "cooldown", "trial_running", "opened", "last_error"}
+
+    @property
+    def settings(self):
+        return config.get('circuit_breaker', {})
+
+    def key_for(self, slot):
+        # Quotas are usually per Google account, and every slot here shares the browser's account
+        return slot['aistudio_url'] if self.settings.get('scope', 'account') == 'slot' else 'account'
+
+    def retry_after(self, key):
+        """Seconds until requests for key may go through again, or None if they may go now"""
+        with self.lock:
+            state = self.states.get(key)
+            if state is None:
+                return None
+            remaining = state["open_until"] - time.time()
+            if remaining > 0:
+                return remaining
+            if state["trial_running"]:
+                return self.settings.get('trial_wait', 30)
+            return None
+
+    def before_request(self, key):
+        """Raise QuotaExceeded if key's breaker is open, otherwise let the request through.
+        Returns True if the request is the trial request of a half open breaker."""
+        if not self.settings.get('enabled', True):
+            return False
+        retry_after = self.retry_after(key)
+        if retry_after is not None:
+            raise QuotaExceeded(f"AI Studio quota reached, requests are paused for {retry_after:.0f} more seconds",
+                                retry_after=retry_after)
+        with self.lock:
+            state = self.states.get(key)
+            if state is None:
+                return False
+            state["trial_running"] = True
+            return True
+
+    def end_trial(self, key):
+        """The trial request ended without telling us anything about the quota, let another one try"""
+        with self.lock:
+            state = self.states.get(key)
+            if state is not None:
+                state["trial_running"] = False
+
+    def record_quota_error(self, key, message):
+        with self.lock:
+            state = self.states.get(key)
+            base = self.settings.get('cooldown_seconds', 300)
+            if state is None:
+                cooldown = base
+            else:
+                cooldown = min(state["cooldown"] * 2, self.settings.get('max_cooldown_seconds', 3600))
+            self.states[key] = {"open_until": time.time() + cooldown, "cooldown": cooldown,
+                                "trial_running": False, "opened": time.time(), "last_error": message}
+        logging.warning(f"Circuit breaker for {key} opened for {cooldown} seconds: {message}")
+        return cooldown
+
+    def record_result(self, key):
+        """A request for key finished without a quota error, so close its breaker"""
+        with self.lock:
+            if self.states.pop(key, None) is not None:
+                logging.info(f"Circuit breaker for {key} closed")
+
+    def all_open(self, keys):
+        """Shortest wait if every key is open, or None if any of them can take requests"""
+        waits = [self.retry_after(key) for key in keys]
+        if not waits or any(wait is None for wait in waits):
+            return None
+        return min(waits)
+
+    def snapshot(self):
+        with self.lock:
+            return {key: {"retry_after": max(0, state["open_until"] - time.time()), "cooldown": state["cooldown"],
+                          "last_error": state["last_error"]} for key, state in self.states.items()}
+
+circuit_breaker = CircuitBreaker()
+
+# --- Adaptive Timeouts ---
+# Which observed stage each timeout in config['timeouts'] is learned from
+TIMEOUT_STAGES = {
+    'before_run_button_click': 'button_ready',
+    'max_wait_start': 'run_start',
+    'max_wait_complete': 'run_complete',
+    'additional_wait': 'finalize',
+}
+# Caps on polling loops that already stop as soon as AI Studio is done. Lowering them saves nothing and
+# only cuts off slower than usual generations, so learning may raise them but never lower them.
+RAISE_ONLY_TIMEOUTS = ('max_wait_start', 'max_wait_complete')
+
+# Prompt size buckets (characters in the transformed request file)
+PROMPT_SIZE_BUCKETS = [(20000, 'small'), (200000, 'medium'), (1000000, 'large'), (None, 'huge')]
+
+class StageStats:
+    """Rolling statistics (EWMA mean and variance) of each automation stage's duration, bucketed by prompt size"""
+    def __init__(self, path, smoothing=0.2, save_interval=30):
+        self.path = path
+        self.smoothing = smoothing
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.dirty = False
+        self.last_save = time.monotonic()
+        self.load()
+
+    @staticmethod
+    def bucket_for(prompt_size):
+        for limit, name in PROMPT_SIZE_BUCKETS:
+            if limit is None or prompt_size < limit:
+                return name
+
+    def load(self):
+        """Load the learned model saved by a previous run, if there is one"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.buckets = json.load(f)
+            logging.info(f"Loaded stage timing statistics from {self.path}")
+        except FileNotFoundError:
+            pass
+        except (json.JSONDecodeError, OSError) as e:
+            logging.warning(f"Could not load stage timing statistics, starting fresh: {e}")
+
+    def save(self):
+        """Write the model atomically so a crash never leaves a half written file"""
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.buckets, f, indent=2)
+        os.replace(temp_path, self.path)
+        self.dirty = False
+        self.last_save = time.monotonic()
+
+    def flush(self):
+        """Save samples that haven't been written yet (called on shutdown)"""
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                self.save()
+            except OSError as e:
+                logging.warning(f"Could not save stage timing statistics: {e}")
+
+    def record(self, stage, prompt_size, seconds, timed_out=False):
+        """Add one observed duration. Timed out samples only tell us the real duration was longer, so they are inflated.
+        Nothing is recorded while adaptive timeouts are disabled, and the file is written at most every save_interval seconds."""
+        if not ADAPTIVE_TIMEOUTS.get('enabled', False):
+            return
+        if timed_out:
+            seconds *= 1.5
+        with self.lock:
+            stats = self.buckets.setdefault(self.bucket_for(prompt_size), {}).setdefault(
+                stage, {"count": 0, "mean": 0.0, "variance": 0.0, "max": 0.0})
+            if stats["count"] == 0:
+                stats["mean"] = seconds
+            else:
+                diff = seconds - stats["mean"]
+                increment = self.smoothing * diff
+                stats["mean"] += increment
+                stats["variance"] = (1 - self.smoothing) * (stats["variance"] + diff * increment)
+            stats["count"] += 1
+            stats["max"] = max(stats["max"], seconds)
+            self.dirty = True
+            if time.monotonic() - self.last_save < self.save_interval:
+                return
+            try:
+                self.save()
+            except OSError as e:
+                logging.warning(f"Could not save stage timing statistics: {e}")
+
+    def estimate(self, stage, prompt_size, safety_factor=3, min_samples=5):
+        """Upper estimate (mean + safety_factor standard deviations) of a stage's duration, or None without enough samples"""
+        with self.lock:
+            stats = self.buckets.get(self.bucket_for(prompt_size), {}).get(stage)
+            if not stats or stats["count"] < min_samples:
+                return None
+            return stats["mean"] + safety_factor * stats["variance"] ** 0.5
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.buckets))
+
+stage_stats = StageStats(ADAPTIVE_TIMEOUTS.get('stats_file', 'stage_stats.json'),
+                         smoothing=ADAPTIVE_TIMEOUTS.get('smoothing', 0.2),
+                         save_interval=ADAPTIVE_TIMEOUTS.get('save_interval', 30))
+
+def get_timeout(name, prompt_size):
+    """Timeout or wait for the given config['timeouts'] entry, learned from observed durations when possible"""
+    configured = config['timeouts'][name]
+    if not ADAPTIVE_TIMEOUTS.get('enabled', False):
+        return configured
+    learned = stage_stats.estimate(TIMEOUT_STAGES[name], prompt_size,
+                                   safety_factor=ADAPTIVE_TIMEOUTS.get('safety_factor', 3),
+                                   min_samples=ADAPTIVE_TIMEOUTS.get('min_samples', 5))
+    if learned is None:
+        return configured
+    # Learned values may grow past the hand-tuned value for huge prompts, but only up to max_scale times it
+    upper_bound = configured * ADAPTIVE_TIMEOUTS.get('max_scale', 2)
+    lower_bound = configured if name in RAISE_ONLY_TIMEOUTS else ADAPTIVE_TIMEOUTS.get('min_seconds', 0.5)
+    return max(lower_bound, min(learned, upper_bound))
 
 # --- Flask App Initialization ---
 app = flask.Flask(__name__)
@@ -90,7 +457,9 @@ class AIStudioAutomation:
     def __init__(self):
         self.browser = None
         self.context = None
-        self.page = None
+        self.page = None  # AI Studio tab
+        self.drive_page = None  # Drive tab, so uploads can happen while AI Studio is generating
+        self.focus_lock = None  # Held while a tab needs focus (keyboard, mouse, clipboard)
         self.is_authenticated = False
     
     async def initialize_browser(self, headless=None):
@@ -115,6 +484,9 @@ class AIStudioAutomation:
             self.page = pages[0]
         else:
             self.page = await self.browser.new_page()
+        self.drive_page = await self.browser.new_page()
+        if self.focus_lock is None:
+            self.focus_lock = asyncio.Lock()
         
         await self.check_authentication(headless)
     
@@ -154,52 +526,55 @@ class AIStudioAutomation:
             logging.error(f"Error checking authentication: {e}")
             self.is_authenticated = False
     
-    async def upload_to_drive(self, file_path):
-        """Upload file to Google Drive folder using file chooser interception"""
+    async def upload_to_drive(self, file_path, replaces_existing=True):
+        """Upload file (or a list of files, side by side) to Google Drive folder using file chooser interception.
+        replaces_existing is False for new files, which don't get Drive's replace dialog."""
+        file_paths = file_path if isinstance(file_path, list) else [file_path]
+        file_names = ", ".join(os.path.basename(path) for path in file_paths)
         try:
-            await self.page.goto(DRIVE_FOLDER_URL)
-            await self.page.wait_for_load_state('networkidle')
+            await self.drive_page.goto(DRIVE_FOLDER_URL)
+            await self.drive_page.wait_for_load_state('networkidle')
             
             # Wait for page to fully load
             await asyncio.sleep(2)
             
-            logging.info(f"Uploading {os.path.basename(file_path)} using file chooser interception")
+            logging.info(f"Uploading {file_names} using file chooser interception")
             
             # Set up file chooser interception before triggering the upload
-            async with self.page.expect_file_chooser() as fc_info:
+            async with self.drive_page.expect_file_chooser() as fc_info:
                 # Try multiple methods to trigger file upload
                 try:
                     # Method 1: Try the keyboard shortcut Alt+C, U
-                    await self.page.keyboard.press('Alt+c')
+                    await self.drive_page.keyboard.press('Alt+c')
                     await asyncio.sleep(0.5)
-                    await self.page.keyboard.press('u')
+                    await self.drive_page.keyboard.press('u')
                 except:
                     try:
                         # Method 2: Look for "New" button and click it, then look for upload option
-                        new_button = self.page.locator('button:has-text("New")')
+                        new_button = self.drive_page.locator('button:has-text("New")')
                         if await new_button.count() > 0:
                             await new_button.click()
                             await asyncio.sleep(1)
                             
                             # Look for file upload option
-                            upload_option = self.page.locator('text="File upload"')
+                            upload_option = self.drive_page.locator('text="File upload"')
                             if await upload_option.count() > 0:
                                 await upload_option.click()
                             else:
                                 # Try alternative text
-                                upload_option = self.page.locator('text="Upload"')
+                                upload_option = self.drive_page.locator('text="Upload"')
                                 await upload_option.click()
                     except:
                         # Method 3: Try right-click context menu
-                        await self.page.click('body', button='right')
+                        await self.drive_page.click('body', button='right')
                         await asyncio.sleep(0.5)
-                        upload_option = self.page.locator('text="Upload"')
+                        upload_option = self.drive_page.locator('text="Upload"')
                         if await upload_option.count() > 0:
                             await upload_option.click()
             
             # Get the file chooser and set the file
             file_chooser = await fc_info.value
-            await file_chooser.set_files(file_path)
+            await file_chooser.set_files(file_paths)
             
             logging.info("File chooser intercepted and file set successfully")
             
@@ -207,62 +582,87 @@ class AIStudioAutomation:
             # Wait a moment for the upload dialog to appear
             await asyncio.sleep(2)
             
-            # Find and click the Upload button using the exact method you specified
-            try:
-                upload_button = self.page.get_by_role('button', name='Upload')
-                await upload_button.click()
-                logging.info("Clicked Upload button successfully")
-            except Exception as e:
-                logging.warning(f"Could not find Upload button with get_by_role: {e}")
-                # Fallback methods
+            if not replaces_existing:
+                # Only shows up if a file with the same name is already there
                 try:
-                    # Try alternative selector
-                    upload_button = self.page.locator('button:has-text("Upload")')
+                    await self.drive_page.get_by_role('button', name='Upload').click(timeout=3000)
+                except Exception:
+                    pass
+            else:
+                # Find and click the Upload button using the exact method you specified
+                try:
+                    upload_button = self.drive_page.get_by_role('button', name='Upload')
                     await upload_button.click()
-                    logging.info("Clicked Upload button using fallback selector")
-                except Exception as e2:
-                    logging.error(f"Failed to click Upload button: {e2}")
-                    raise
+                    logging.info("Clicked Upload button successfully")
+                except Exception as e:
+                    logging.warning(f"Could not find Upload button with get_by_role: {e}")
+                    # Fallback methods
+                    try:
+                        # Try alternative selector
+                        upload_button = self.drive_page.locator('button:has-text("Upload")')
+                        await upload_button.click()
+                        logging.info("Clicked Upload button using fallback selector")
+                    except Exception as e2:
+                        logging.error(f"Failed to click Upload button: {e2}")
+                        raise
             
             # Wait for upload to process
             await asyncio.sleep(4)  # Adjust this as needed for internet speed, 4 is usually enough
-            logging.info(f"File upload completed: {os.path.basename(file_path)}")
+            logging.info(f"File upload completed: {file_names}")
             
         except Exception as e:
             logging.error(f"Error uploading to Drive using file chooser: {e}")
             raise
     
-    async def run_ai_studio_prompt(self):
+    async def run_ai_studio_prompt(self, prompt_size=0, aistudio_url=None):
         """Navigate to AI Studio and run the prompt"""
         try:
-            await self.page.goto(AISTUDIO_URL)
-            await self.page.wait_for_load_state('networkidle')
-            await asyncio.sleep(2) # Wait for the run button to fully load
+            # Only loading the prompt and clicking Run need the tab focused, waiting for the response doesn't
+            async with self.focus_lock:
+                await self.page.bring_to_front()
+                await self.page.goto(aistudio_url or AISTUDIO_URL)
+                await self.page.wait_for_load_state('networkidle')
+                await asyncio.sleep(2) # Wait for the run button to fully load
             
-            # Find and click the Run button
-            run_button = self.page.locator('button[aria-label="Run"]')
+                # Find and click the Run button
+                run_button = self.page.locator('button[aria-label="Run"]')
+                options_buttons = self.page.locator('button[aria-label="Open options"]')
             
-            # Check initial state
-            initial_state = await run_button.get_attribute('aria-disabled')
-            logging.info(f"Initial button state: aria-disabled='{initial_state}'")
+                # Check initial state
+                initial_state = await run_button.get_attribute('aria-disabled')
+                logging.info(f"Initial button state: aria-disabled='{initial_state}'")
             
-            # Wait before clicking the run button to ensure page is fully loaded
-            before_click_delay = config['timeouts']['before_run_button_click']
-            logging.info(f"Waiting {before_click_delay} seconds before clicking run button...")
-            await asyncio.sleep(before_click_delay)
+                before_click_delay = get_timeout('before_run_button_click', prompt_size)
+                if ADAPTIVE_TIMEOUTS.get('enabled', False):
+                    # Wait until the run button is enabled (at most before_run_button_click seconds) to ensure page is fully loaded
+                    logging.info(f"Waiting up to {before_click_delay:.1f} seconds for the run button to be ready...")
+                    stage_start = time.monotonic()
+                    while time.monotonic() - stage_start < before_click_delay:
+                        if await run_button.get_attribute('aria-disabled') == 'false':
+                            break
+                        await asyncio.sleep(0.25)
+                    waited = time.monotonic() - stage_start
+                    stage_stats.record('button_ready', prompt_size, waited, timed_out=waited >= before_click_delay)
+                else:
+                    # Wait before clicking to ensure page is fully loaded
+                    logging.info(f"Waiting {before_click_delay} seconds before clicking run button...")
+                    await asyncio.sleep(before_click_delay)
             
-            await run_button.click()
-            logging.info("Clicked Run button")
+                responses_before = await options_buttons.count()
+                await run_button.click()
+                logging.info("Clicked Run button")
             
-            # Wait a moment for the button state to change
-            await asyncio.sleep(2)
+                # Wait a moment for the button state to change
+                await asyncio.sleep(2)
             
             # Monitor the aria-disabled attribute - wait for it to become true (processing)
             logging.info("Waiting for AI Studio to start processing...")
-            max_wait_start = config['timeouts']['max_wait_start']  # longest i've seen aistudio take to finish processing is 1000 seconds for extra long coding projects
+            max_wait_start = get_timeout('max_wait_start', prompt_size)  # longest i've seen aistudio take to finish processing is 1000 seconds for extra long coding projects
             wait_count = 0
+            stage_start = time.monotonic()
             
             while wait_count < max_wait_start:
+                await self.check_for_page_error()
                 disabled_state = await run_button.get_attribute('aria-disabled')
                 logging.info(f"Button state check: aria-disabled='{disabled_state}'")
                 
@@ -273,15 +673,19 @@ class AIStudioAutomation:
                 await asyncio.sleep(1)
                 wait_count += 1
             
+            stage_stats.record('run_start', prompt_size, time.monotonic() - stage_start,
+                               timed_out=wait_count >= max_wait_start)
             if wait_count >= max_wait_start:
                 logging.warning("Timeout waiting for processing to start - continuing anyway")
             
             # Wait for processing to complete - wait for aria-disabled to become false
             logging.info("Waiting for AI Studio to complete processing...")
-            max_wait_complete = config['timeouts']['max_wait_complete']  # 1 seconds timeout to account for aistudio.google.com delay
+            max_wait_complete = get_timeout('max_wait_complete', prompt_size)  # 1 seconds timeout to account for aistudio.google.com delay
             wait_count = 0
+            stage_start = time.monotonic()
             
             while wait_count < max_wait_complete:
+                await self.check_for_page_error()
                 disabled_state = await run_button.get_attribute('aria-disabled')
                 
                 if disabled_state == 'false':
@@ -295,13 +699,26 @@ class AIStudioAutomation:
                 await asyncio.sleep(1)
                 wait_count += 1
             
+            stage_stats.record('run_complete', prompt_size, time.monotonic() - stage_start,
+                               timed_out=wait_count >= max_wait_complete)
             if wait_count >= max_wait_complete:
                 logging.warning("Timeout waiting for processing to complete - continuing anyway")
             
-            # Wait additional seconds as sometimes AI studio takes a moment to finalize
-            additional_wait = config['timeouts']['additional_wait']
-            logging.info(f"Waiting additional {additional_wait} seconds...")
-            await asyncio.sleep(additional_wait)
+            additional_wait = get_timeout('additional_wait', prompt_size)
+            if ADAPTIVE_TIMEOUTS.get('enabled', False):
+                # Sometimes AI studio takes a moment to finalize, wait (at most additional_wait seconds) for the response's options button
+                logging.info(f"Waiting up to {additional_wait:.1f} additional seconds for the response to finalize...")
+                stage_start = time.monotonic()
+                while time.monotonic() - stage_start < additional_wait:
+                    if await options_buttons.count() > responses_before:
+                        break
+                    await asyncio.sleep(0.25)
+                waited = time.monotonic() - stage_start
+                stage_stats.record('finalize', prompt_size, waited, timed_out=waited >= additional_wait)
+            else:
+                # Sometimes AI studio takes a moment to finalize
+                logging.info(f"Waiting additional {additional_wait} seconds...")
+                await asyncio.sleep(additional_wait)
             
         except Exception as e:
             logging.error(f"Error running AI Studio prompt: {e}")
@@ -561,6 +978,146 @@ class AIStudioAutomation:
                     pass
             return "[Error: Could not retrieve response from AI Studio]"
     
+    async def check_for_page_error(self):
+        """Raise as soon as AI Studio shows a quota or error message instead of a response"""
+        try:
+            messages = await self.page.locator(PAGE_ERROR_SELECTOR).all_inner_texts()
+        except Exception:
+            return
+        for message in messages:
+            message = " ".join(message.split())
+            if QUOTA_ERROR_PATTERN.search(message):
+                raise QuotaExceeded(f"AI Studio reported: {message}")
+            if PAGE_ERROR_PATTERN.search(message):
+                raise AIStudioError(f"AI Studio reported: {message}")
+
+    async def find_drive_file_id(self, file_name, timeout):
+        """Drive file id of a file in the folder listing, waiting up to timeout seconds for its upload to finish"""
+        row = self.drive_page.locator(f'[data-id]:has-text("{file_name}")').first
+        try:
+            await row.wait_for(timeout=timeout * 1000)
+            return await row.get_attribute('data-id')
+        except Exception as e:
+            logging.warning(f"Could not find {file_name} in the Drive folder: {e}")
+            return None
+
+    async def upload_attachments(self, transformed_data):
+        """Upload the request's inline images to Drive, each distinct image only once, and return
+        the request with the images referenced by Drive id. Images that couldn't be uploaded stay inline."""
+        settings = config.get('attachments', {})
+        directory = settings.get('directory', 'attachments')
+        chunks = transformed_data["chunkedPrompt"]["chunks"]
+
+        digests = []
+        new_images = {}  # content hash -> local copy to upload
+        for chunk in chunks:
+            image = chunk.get("inlineImage")
+            if image is None:
+                digests.append(None)
+                continue
+            image_bytes = base64.b64decode(image["data"])
+            digest = hashlib.sha256(image_bytes).hexdigest()
+            digests.append(digest)
+            if attachment_registry.get(digest) is None and digest not in new_images:
+                # Named by content, so the same image always has the same name in Drive
+                file_name = f"{digest[:32]}{mimetypes.guess_extension(image['mimeType']) or ''}"
+                os.makedirs(directory, exist_ok=True)
+                path = os.path.abspath(os.path.join(directory, file_name))
+                with open(path, 'wb') as f:
+                    f.write(image_bytes)
+                new_images[digest] = path
+
+        if new_images:
+            logging.info(f"Uploading {len(new_images)} new image(s), {len([d for d in digests if d]) - len(new_images)} already in Drive")
+            await self.upload_to_drive(list(new_images.values()), replaces_existing=False)
+            for digest, path in new_images.items():
+                file_id = await self.find_drive_file_id(os.path.basename(path), settings.get('upload_timeout', 60))
+                if file_id is not None:
+                    attachment_registry.put(digest, file_id)
+
+        new_chunks = []
+        for chunk, digest in zip(chunks, digests):
+            file_id = attachment_registry.get(digest) if digest else None
+            if file_id is not None:
+                chunk = {key: value for key, value in chunk.items() if key != "inlineImage"}
+                chunk["driveImage"] = {"id": file_id}
+            new_chunks.append(chunk)
+        result = dict(transformed_data)
+        result["chunkedPrompt"] = dict(transformed_data["chunkedPrompt"], chunks=new_chunks)
+        return result
+
+    async def load_drive_folder(self):
+        """Load the Drive folder the way every upload does, returning how long it took"""
+        started = time.monotonic()
+        await self.drive_page.goto(DRIVE_FOLDER_URL)
+        await self.drive_page.wait_for_load_state('networkidle')
+        return time.monotonic() - started
+
+    async def list_drive_files(self):
+        """Id and name of each file in the loaded Drive folder listing"""
+        files = {}
+        rows = self.drive_page.locator('[data-id]')
+        for i in range(await rows.count()):
+            row = rows.nth(i)
+            file_id = await row.get_attribute('data-id')
+            text = (await row.inner_text()).strip()
+            if file_id and text and file_id not in files:
+                files[file_id] = text.split("\n")[0].strip()
+        return [{"id": file_id, "name": name} for file_id, name in files.items()]
+
+    async def trash_drive_file(self, file_id):
+        """Move a file in the loaded Drive folder to the trash"""
+        await self.drive_page.locator(f'[data-id="{file_id}"]').first.click()
+        await self.drive_page.keyboard.press('Delete')
+        await asyncio.sleep(1)
+
+    async def prune_drive_revisions(self, file_id, keep, max_deletions, stop_at):
+        """Delete all but the newest keep versions of a file through Drive's Manage versions dialog, deleting
+        at most max_deletions and stopping at stop_at (time.monotonic()). Returns (versions deleted, error or None)."""
+        deleted = 0
+        try:
+            await self.drive_page.locator(f'[data-id="{file_id}"]').first.click(button='right')
+            await self.drive_page.get_by_role('menuitem', name=re.compile('File information')).click()
+            await self.drive_page.get_by_role('menuitem', name=re.compile('Manage versions')).click()
+            dialog = self.drive_page.get_by_role('dialog')
+            await dialog.wait_for(timeout=10000)
+            await asyncio.sleep(2)  # Wait for the version list to load
+
+            # Newest versions are listed first, so delete from the bottom of the list
+            more_buttons = dialog.get_by_role('button', name=re.compile('More actions'))
+            while deleted < max_deletions and time.monotonic() < stop_at:
+                versions = await more_buttons.count()
+                if versions <= keep:
+                    break
+                await more_buttons.last.click()
+                await self.drive_page.get_by_role('menuitem', name='Delete').click()
+                confirm = self.drive_page.get_by_role('button', name='Delete')
+                if await confirm.count() > 0:
+                    await confirm.last.click()
+                # Only count the version once it is really gone, and give up if it never goes
+                for _ in range(20):
+                    await asyncio.sleep(0.5)
+                    if await more_buttons.count() < versions:
+                        break
+                else:
+                    return deleted, "a version did not go away after deleting it"
+                deleted += 1
+            return deleted, None
+        except Exception as e:
+            return deleted, str(e)
+        finally:
+            with contextlib.suppress(Exception):
+                await self.drive_page.keyboard.press('Escape')
+
+    async def with_focus(self, page, coro):
+        """Run coro with the given tab in front. Only one tab at a time can use the keyboard, mouse and clipboard."""
+        try:
+            async with self.focus_lock:
+                await page.bring_to_front()
+                return await coro
+        finally:
+            coro.close()  # Only does something if we were cancelled before coro started
+    
     async def close(self):
         """Clean up browser resources"""
         if self.browser:
@@ -573,20 +1130,127 @@ class AIStudioAutomation:
         # The BrowserContext object from launch_persistent_context doesn't have an is_closed() method.
         # We check if the page is closed instead. If the context is closed, the page will be too.
         return (self.browser is not None and
-                self.page is not None and not self.page.is_closed())
+                self.page is not None and not self.page.is_closed() and
+                self.drive_page is not None and not self.drive_page.is_closed())
 
 # Global automation instance
 automation = AIStudioAutomation()
 
+# --- Image Attachments ---
+class AttachmentError(ValueError):
+    """Raised when an image_url content part can't be turned into an attachment"""
+    pass
+
+def load_image(part):
+    """Bytes and MIME type of an image_url content part, from a data URL or a local file"""
+    settings = config.get('attachments', {})
+    image_url = part.get("image_url")
+    url = image_url.get("url") if isinstance(image_url, dict) else image_url
+    if not isinstance(url, str) or not url:
+        raise AttachmentError("image_url part has no url")
+
+    if url.startswith("data:"):
+        header, separator, data = url.partition(",")
+        if not separator or not header.endswith(";base64"):
+            raise AttachmentError("Only base64 encoded data URLs are supported")
+        mime_type = header[len("data:"):].split(";")[0] or "image/png"
+        try:
+            image_bytes = base64.b64decode(data, validate=True)
+        except binascii.Error as e:
+            raise AttachmentError(f"Invalid base64 image data: {e}")
+    elif url.startswith(("http://", "https://")):
+        raise AttachmentError("Image URLs on the web are not supported, send the image as a data URL")
+    else:
+        if not settings.get('allow_local_files', False):
+            raise AttachmentError("Local image files are disabled in config.json")
+        path = urllib.request.url2pathname(urllib.parse.urlparse(url).path) if url.startswith("file:") else url
+        mime_type = mimetypes.guess_type(path)[0]
+        if mime_type is None or not mime_type.startswith("image/"):
+            raise AttachmentError(f"{url} is not an image file")
+        try:
+            with open(path, 'rb') as f:
+                image_bytes = f.read()
+        except OSError as e:
+            raise AttachmentError(f"Could not read image {url}: {e}")
+
+    max_bytes = settings.get('max_bytes', 20 * 1024 * 1024)
+    if len(image_bytes) > max_bytes:
+        raise AttachmentError(f"Image is {len(image_bytes)} bytes, the limit is {max_bytes}")
+    return image_bytes, mime_type
+
+def image_chunk(part):
+    """AI Studio prompt chunk with the image inline, swapped for a Drive reference when it is uploaded"""
+    image_bytes, mime_type = load_image(part)
+    return {"role": "user", "inlineImage": {"mimeType": mime_type, "data": base64.b64encode(image_bytes).decode('ascii')}}
+
+class AttachmentRegistry:
+    """Drive file ids of images uploaded so far, by content hash, kept across restarts"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (json.JSONDecodeError, OSError) as e:
+            logging.warning(f"Could not load the attachment registry, images will be uploaded again: {e}")
+
+    def save(self):
+        """Write atomically so a crash never leaves a half written file"""
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(temp_path, self.path)
+
+    def get(self, digest):
+        with self.lock:
+            entry = self.entries.get(digest)
+            return entry["id"] if entry else None
+
+    def put(self, digest, file_id):
+        with self.lock:
+            self.entries[digest] = {"id": file_id, "uploaded_at": int(time.time())}
+            self.try_save()
+
+    def remove_file(self, file_id):
+        """Forget an image whose Drive file was deleted, so it is uploaded again if it comes back"""
+        with self.lock:
+            for digest, entry in list(self.entries.items()):
+                if entry["id"] == file_id:
+                    del self.entries[digest]
+            self.try_save()
+
+    def uploaded_at(self, file_id):
+        with self.lock:
+            for entry in self.entries.values():
+                if entry["id"] == file_id:
+                    return entry["uploaded_at"]
+            return None
+
+    def try_save(self):
+        try:
+            self.save()
+        except OSError as e:
+            logging.warning(f"Could not save the attachment registry: {e}")
+
+attachment_registry = AttachmentRegistry(config.get('attachments', {}).get('registry_file', 'attachments.json'))
+
 # --- Transformation Logic (Updated to use config) ---
 def transform_to_gemini_format(openai_request_data):
+    # Read the settings once so a config reload can't mix old and new values in one request
+    gemini = config['gemini']
     GEMINI_BOILERPLATE = {
       "runSettings": {
-        "temperature": config['gemini']['temperature'],
-        "model": config['gemini']['model'], # Must be adjusted in the future when google comes out with new models
-        "topP": config['gemini']['top_p'],
-        "topK": config['gemini']['top_k'],
-        "maxOutputTokens": config['gemini']['max_output_tokens'],
+        "temperature": gemini['temperature'],
+        "model": gemini['model'], # Must be adjusted in the future when google comes out with new models
+        "topP": gemini['top_p'],
+        "topK": gemini['top_k'],
+        "maxOutputTokens": gemini['max_output_tokens'],
         "safetySettings": [{
           "category": "HARM_CATEGORY_HARASSMENT",
           "threshold": "OFF"
@@ -600,12 +1264,12 @@ def transform_to_gemini_format(openai_request_data):
           "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
           "threshold": "OFF"
         }],
-        "responseMimeType": config['gemini']['response_mime_type'],
-        "enableCodeExecution": config['gemini']['enable_code_execution'],
-        "enableSearchAsATool": config['gemini']['enable_search_as_tool'],
-        "enableBrowseAsATool": config['gemini']['enable_browse_as_tool'],
-        "enableAutoFunctionResponse": config['gemini']['enable_auto_function_response'],
-        "thinkingBudget": config['gemini']['thinking_budget']
+        "responseMimeType": gemini['response_mime_type'],
+        "enableCodeExecution": gemini['enable_code_execution'],
+        "enableSearchAsATool": gemini['enable_search_as_tool'],
+        "enableBrowseAsATool": gemini['enable_browse_as_tool'],
+        "enableAutoFunctionResponse": gemini['enable_auto_function_response'],
+        "thinkingBudget": gemini['thinking_budget']
       },
       "systemInstruction": {},
       "chunkedPrompt": {
@@ -634,8 +1298,14 @@ def transform_to_gemini_format(openai_request_data):
         elif role == "user":
             chunk["role"] = "user"
             if isinstance(content, list):
-                text_parts = [part.get("text", "") for part in content if isinstance(part, dict)]
+                parts = [part for part in content if isinstance(part, dict)]
+                # Images go before the text as chunks of their own, like images attached in AI Studio
+                images = [image_chunk(part) for part in parts if part.get("type") == "image_url"]
+                chunks.extend(images)
+                text_parts = [part.get("text", "") for part in parts if part.get("type") != "image_url"]
                 chunk["text"] = "\n".join(text_parts)
+                if images and not chunk["text"]:
+                    continue
             else:
                 chunk["text"] = content
         
@@ -645,69 +1315,628 @@ def transform_to_gemini_format(openai_request_data):
     transformed_data["chunkedPrompt"]["chunks"] = chunks
     return transformed_data
 
+# --- Token Estimation ---
+# Words, numbers and single punctuation marks. Gemini's tokenizer averages about 4 characters per token
+# for English and code, so long words are split into 4 character pieces.
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+TOKENS_PER_CHUNK = 4  # role and turn separators added around every chunk
+IMAGE_TOKENS = 258  # Gemini counts every image as the same number of tokens
+
+def estimate_tokens(text):
+    """Fast local estimate of how many tokens a piece of text uses"""
+    if not text:
+        return 0
+    if not isinstance(text, str):
+        text = json.dumps(text)
+    return sum((len(piece) + 3) // 4 for piece in TOKEN_PATTERN.findall(text))
+
+def estimate_prompt_tokens(transformed_data):
+    """Estimate the prompt tokens of a request already in Gemini format"""
+    tokens = estimate_tokens(transformed_data["systemInstruction"].get("text"))
+    for chunk in transformed_data["chunkedPrompt"]["chunks"]:
+        tokens += estimate_tokens(chunk.get("text")) + TOKENS_PER_CHUNK
+        if "inlineImage" in chunk or "driveImage" in chunk:
+            tokens += IMAGE_TOKENS
+    return tokens
+
+def get_context_limit():
+    """Maximum prompt tokens for the configured model, or None if no limit is configured"""
+    return config['gemini'].get('context_window_tokens', {}).get(config['gemini']['model'])
+
+def build_usage(prompt_tokens, completion_content):
+    completion_tokens = estimate_tokens(completion_content)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+# --- Near-Duplicate Prompt Cache ---
+SIMILARITY_WORD_PATTERN = re.compile(r"\w+")
+SIMILARITY_NUMBER_PATTERN = re.compile(r"\d+")
+
+class SimilarityCache:
+    """Answers prompts that are nearly the same as an earlier one from the earlier answer.
+
+    Every chunk's text is normalized (lowercased, numbers masked so timestamps don't count) and cut into
+    word shingles. A bottom-k MinHash sketch of the shingles estimates how similar two prompts are, and an
+    inverted index from sketch values to entries finds candidates without comparing against every entry.
+    The run settings and the last message must match exactly, only the context around them may differ."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # entry id -> entry, least recently used first
+        self.index = {}  # sketch value -> set of entry ids
+        self.next_id = 0
+        self.stats = {"lookups": 0, "hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0,
+                      "hit_similarity_total": 0.0,
+                      "hit_similarity": {"0.99-1.00": 0, "0.95-0.99": 0, "below 0.95": 0}}
+
+    @property
+    def settings(self):
+        return config.get('similarity_cache', {})
+
+    def enabled_for(self, route):
+        return self.settings.get('enabled', False) and route in self.settings.get('routes', ['/v1/chat/completions'])
+
+    @staticmethod
+    def normalize(text):
+        if not isinstance(text, str):
+            text = json.dumps(text) if text else ""
+        return SIMILARITY_NUMBER_PATTERN.sub("0", text.lower())
+
+    @staticmethod
+    def image_key(chunk):
+        """Identity of an image chunk (content hash or Drive id), or None for text"""
+        if "inlineImage" in chunk:
+            return "image " + hashlib.sha256(chunk["inlineImage"]["data"].encode('ascii')).hexdigest()
+        if "driveImage" in chunk:
+            return "drive image " + chunk["driveImage"]["id"]
+        return None
+
+    def fingerprint(self, transformed_data):
+        """Sketch of the whole prompt, plus an exact key for the settings, the images and the last message"""
+        shingle_words = self.settings.get('shingle_words', 5)
+        sketch_size = self.settings.get('sketch_size', 128)
+        chunks = transformed_data["chunkedPrompt"]["chunks"]
+        images = [self.image_key(chunk) for chunk in chunks if self.image_key(chunk) is not None]
+        texts = [self.normalize(transformed_data["systemInstruction"].get("text"))]
+        texts.extend(f"{chunk.get('role')}: {self.image_key(chunk) or self.normalize(chunk.get('text'))}"
+                     for chunk in chunks)
+
+        shingle_hashes = set()
+        for text in texts:
+            words = SIMILARITY_WORD_PATTERN.findall(text)
+            for i in range(max(1, len(words) - shingle_words + 1)):
+                shingle = " ".join(words[i:i + shingle_words]).encode('utf-8')
+                shingle_hashes.add(int.from_bytes(hashlib.blake2b(shingle, digest_size=8).digest(), 'big'))
+        sketch = heapq.nsmallest(sketch_size, shingle_hashes)
+
+        # Images must all match exactly, two prompts asking about different images are different prompts
+        exact = json.dumps([transformed_data["runSettings"], images, chunks[-1] if chunks else None], sort_keys=True)
+        return {"sketch": sketch, "exact_key": hashlib.sha256(exact.encode('utf-8')).hexdigest()}
+
+    @staticmethod
+    def similarity(sketch_a, sketch_b, sketch_size):
+        """Estimated Jaccard similarity of two bottom-k sketches"""
+        union_bottom = heapq.nsmallest(sketch_size, set(sketch_a) | set(sketch_b))
+        if not union_bottom:
+            return 1.0
+        both = set(sketch_a) & set(sketch_b)
+        return sum(1 for value in union_bottom if value in both) / len(union_bottom)
+
+    def lookup(self, fingerprint):
+        """Cached answer for a similar enough prompt, as (content, similarity), or None"""
+        threshold = self.settings.get('threshold', 0.9)
+        sketch_size = self.settings.get('sketch_size', 128)
+        ttl = self.settings.get('ttl_seconds', 86400)
+        with self.lock:
+            self.stats["lookups"] += 1
+            candidate_counts = {}
+            for value in fingerprint["sketch"]:
+                for entry_id in self.index.get(value, ()):
+                    candidate_counts[entry_id] = candidate_counts.get(entry_id, 0) + 1
+
+            best_id, best_similarity = None, 0.0
+            # Entries sharing the most sketch values are the most likely matches
+            for entry_id, _ in sorted(candidate_counts.items(), key=lambda item: -item[1])[:20]:
+                entry = self.entries[entry_id]
+                if time.time() - entry["created"] > ttl:
+                    self.remove(entry_id)
+                    self.stats["expired"] += 1
+                    continue
+                if entry["exact_key"] != fingerprint["exact_key"]:
+                    continue
+                similarity = self.similarity(entry["sketch"], fingerprint["sketch"], sketch_size)
+                if similarity > best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+
+            if best_id is None or best_similarity < threshold:
+                self.stats["misses"] += 1
+                return None
+
+            entry = self.entries[best_id]
+            self.entries.move_to_end(best_id)
+            entry["hits"] += 1
+            self.stats["hits"] += 1
+            self.stats["hit_similarity_total"] += best_similarity
+            if best_similarity >= 0.99:
+                self.stats["hit_similarity"]["0.99-1.00"] += 1
+            elif best_similarity >= 0.95:
+                self.stats["hit_similarity"]["0.95-0.99"] += 1
+            else:
+                self.stats["hit_similarity"]["below 0.95"] += 1
+            return entry["content"], best_similarity
+
+    def store(self, fingerprint, content):
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = {"sketch": fingerprint["sketch"], "exact_key": fingerprint["exact_key"],
+                                      "content": content, "created": time.time(), "hits": 0}
+            for value in fingerprint["sketch"]:
+                self.index.setdefault(value, set()).add(entry_id)
+            self.stats["stores"] += 1
+            while len(self.entries) > self.settings.get('max_entries', 500):
+                self.remove(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def remove(self, entry_id):
+        """Drop an entry and its index references (lock must be held)"""
+        entry = self.entries.pop(entry_id)
+        for value in entry["sketch"]:
+            ids = self.index.get(value)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self.index[value]
+
+    def snapshot(self):
+        with self.lock:
+            stats = json.loads(json.dumps(self.stats))
+            stats["entries"] = len(self.entries)
+            stats["hit_rate"] = stats["hits"] / stats["lookups"] if stats["lookups"] else None
+            stats["average_hit_similarity"] = stats.pop("hit_similarity_total") / stats["hits"] if stats["hits"] else None
+            return stats
+
+similarity_cache = SimilarityCache()
+
 # --- Helper Functions ---
 def log_to_file(content):
     """Log function disabled - no longer saving to file"""
     pass  # Logging disabled
 
-def stream_generator(response_id, model_name, content):
-    start_chunk = {
-        "id": response_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model_name,
-        "choices": [{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}]
-    }
-    yield f"data: {json.dumps(start_chunk)}\n\n"
-    content_chunk = {
-        "id": response_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model_name,
-        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+def build_completion(response_id, model_name, content, prompt_tokens):
+    return {
+        "id": response_id, "object": "chat.completion", "created": int(time.time()), "model": model_name,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": build_usage(prompt_tokens, content)
     }
-    yield f"data: {json.dumps(content_chunk)}\n\n"
-    end_chunk = {
+
+# --- Response Compression ---
+def choose_encoding(accept_encoding):
+    """Pick the best content encoding the client accepts: br (if brotli is installed), gzip, or none"""
+    settings = config.get('compression', {})
+    if not settings.get('enabled', True) or not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ('br', 'gzip'):
+        if encoding == 'br' and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+def make_compressor(encoding):
+    """Object with compress(data) and flush() for the given encoding"""
+    level = config.get('compression', {}).get('level', 6)
+    if encoding == 'br':
+        return brotli.Compressor(quality=min(level, 11))
+    # wbits 31 = gzip header and trailer
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+CONTENT_PLACEHOLDER = "\u0000content\u0000"
+
+def completion_json_pieces(payload, piece_size):
+    """Serialize a chat completion, escaping the (possibly huge) message content a slice at a time"""
+    message = payload["choices"][0]["message"]
+    content = message["content"] or ""
+    message["content"] = CONTENT_PLACEHOLDER
+    try:
+        before, after = json.dumps(payload, separators=(',', ':')).split(json.dumps(CONTENT_PLACEHOLDER), 1)
+    finally:
+        message["content"] = content
+    yield before + '"'
+    # Escaping works character by character, so slices can be escaped on their own
+    for start in range(0, len(content), piece_size):
+        yield json.dumps(content[start:start + piece_size])[1:-1]
+    yield '"' + after
+
+def encode_completion_chunks(payload, encoding, body_stats):
+    """Serialize and compress a chat completion as it goes, so no full copy of the body is ever built.
+    Fills body_stats with the uncompressed size, bytes on the wire and peak buffered bytes."""
+    chunk_size = config.get('compression', {}).get('chunk_size', 65536)
+    compressor = make_compressor(encoding) if encoding else None
+    body_stats.update(response_bytes=0, wire_bytes=0, peak_buffer_bytes=0)
+
+    for piece in completion_json_pieces(payload, chunk_size):
+        data = piece.encode('utf-8')
+        body_stats["response_bytes"] += len(data)
+        if compressor is not None:
+            data = compressor.process(data) if encoding == 'br' else compressor.compress(data)
+        body_stats["peak_buffer_bytes"] = max(body_stats["peak_buffer_bytes"], len(piece), len(data))
+        body_stats["wire_bytes"] += len(data)
+        if data:
+            yield data
+    if compressor is not None:
+        tail = compressor.finish() if encoding == 'br' else compressor.flush()
+        body_stats["wire_bytes"] += len(tail)
+        if tail:
+            yield tail
+
+def completion_response(payload, timings=None):
+    """Chat completion response, compressed per Accept-Encoding and sent with chunked transfer encoding
+    as it's serialized. Small bodies are sent in one piece."""
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    min_size = config.get('compression', {}).get('min_size', 1024)
+    body_stats = {}
+    if len(payload["choices"][0]["message"]["content"] or "") < min_size:
+        # Not worth compressing or chunking, send it in one piece
+        data = b"".join(encode_completion_chunks(payload, None, body_stats))
+        if timings is not None:
+            timings.update(body_stats)
+        return Response(data, mimetype='application/json')
+
+    def body():
+        yield from encode_completion_chunks(payload, encoding, body_stats)
+        logging.info(f"Sent response: {body_stats['response_bytes']} bytes, {body_stats['wire_bytes']} on the wire "
+                     f"({encoding or 'uncompressed'}), peak buffer {body_stats['peak_buffer_bytes']} bytes")
+        if timings is not None:
+            timings.update(body_stats)
+
+    headers = {'Vary': 'Accept-Encoding'}
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    return Response(body(), mimetype='application/json', headers=headers)
+
+# Error bodies shared by the JSON and streaming responses
+AUTOMATION_FAILED_ERROR = {
+    "message": "Request failed after multiple attempts. Please check the server logs for more details.",
+    "type": "server_error",
+    "code": "automation_failed"
+}
+
+def quota_error(e):
+    return {"message": f"Rate limit reached: {e}", "type": "requests", "code": "rate_limit_exceeded"}
+
+def quota_error_response(e):
+    response = jsonify({"error": quota_error(e)})
+    response.status_code = 429
+    if e.retry_after:
+        response.headers['Retry-After'] = str(int(e.retry_after + 0.5))
+    return response
+
+def deadline_error(e):
+    return {"message": f"Request timed out: {e}", "type": "timeout_error", "code": "deadline_exceeded"}
+
+def sse_chunk(response_id, model_name, delta=None, finish_reason=None, usage=None):
+    chunk = {
         "id": response_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model_name,
-        "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+        "choices": [{"index": 0, "delta": delta or {}, "finish_reason": finish_reason}]
     }
-    yield f"data: {json.dumps(end_chunk)}\n\n"
+    if usage is not None:
+        # Sent when the client asks for it with stream_options.include_usage, like OpenAI does
+        chunk["choices"] = []
+        chunk["usage"] = usage
+    return f"data: {json.dumps(chunk)}\n\n"
+
+def stream_generator(response_id, model_name, automation_future, prompt_tokens, include_usage, timings, on_content=None):
+    """Send headers and the role chunk right away, then keepalive comments until the automation finishes,
+    so proxies and clients with idle timeouts don't drop the connection during long generations"""
+    yield sse_chunk(response_id, model_name, delta={"role": "assistant"})
+
+    keepalive_interval = config.get('streaming', {}).get('keepalive_interval', 5)
+    error = None
+    try:
+        while True:
+            try:
+                content = automation_future.result(timeout=keepalive_interval)
+                break
+            except concurrent.futures.TimeoutError:
+                yield ": keepalive\n\n"
+            except DeadlineExceeded as e:
+                logging.error(f"Request deadline exceeded: {e}")
+                error = deadline_error(e)
+                break
+            except QuotaExceeded as e:
+                logging.error(f"Request hit the AI Studio quota: {e}")
+                error = quota_error(e)
+                break
+            except Exception as e:
+                logging.error(f"Error in streaming automation: {e}")
+                error = AUTOMATION_FAILED_ERROR
+                break
+    finally:
+        # The client went away, so stop holding the browser for it
+        if not automation_future.done():
+            logging.info("Streaming client disconnected, cancelling its automation")
+            automation_future.cancel()
+
+    if error is None and content is None:
+        error = AUTOMATION_FAILED_ERROR
+    if error is not None:
+        timings['error'] = error['code']
+        yield f"data: {json.dumps({'error': error})}\n\n"
+        yield "data: [DONE]\n\n"
+        return
+
+    if on_content is not None:
+        on_content(content)
+    print("\n--- SENDING STREAMING RESPONSE ---")
+    yield sse_chunk(response_id, model_name, delta={"content": content})
+    yield sse_chunk(response_id, model_name, finish_reason="stop")
+    if include_usage:
+        yield sse_chunk(response_id, model_name, usage=build_usage(prompt_tokens, content))
     yield "data: [DONE]\n\n"
 
 
-async def process_request_with_automation(transformed_data):
-    """Process the request using the global browser automation instance, with retries."""
+async def run_stage(stage, coro, deadline, prompt_size=0, timings=None):
+    """Run one automation stage within its share of the request's deadline, recording how long it took"""
+    try:
+        budget = deadline.budget_for(stage)
+    except DeadlineExceeded:
+        coro.close()
+        raise
+    stage_start = time.monotonic()
+    try:
+        result = await asyncio.wait_for(coro, budget)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(f"The {stage} stage did not finish before the request deadline")
+    elapsed = time.monotonic() - stage_start
+    stage_stats.record(stage, prompt_size, elapsed)
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0) + elapsed
+    return result
+
+# --- Automation Pipeline ---
+class Turnstile:
+    """Lets tickets through one at a time, in ticket order. Tickets that give up are skipped over."""
+    def __init__(self):
+        self.turn = 0
+        self.skipped = set()
+
+    def done(self, ticket):
+        """Mark a ticket as finished (or abandoned) so later tickets can go. Calling it twice is harmless."""
+        if ticket == self.turn:
+            self.turn += 1
+            while self.turn in self.skipped:
+                self.skipped.discard(self.turn)
+                self.turn += 1
+        elif ticket > self.turn:
+            self.skipped.add(ticket)
+
+class AutomationPipeline:
+    """Runs requests through two stages, upload and run (which includes copy), in strict ticket order.
+
+    Each request gets a prompt slot (a Drive file plus the AI Studio prompt that reads it), so the next
+    request's file write and Drive upload can happen while the current request is generating. A slot is
+    only uploaded to again once the request that last used it has finished running, so a prompt is never
+    overwritten before AI Studio has run it."""
+    def __init__(self, slot_count):
+        self.slot_count = max(1, slot_count)
+        self.next_ticket = 0
+        self.upload = Turnstile()
+        self.run = Turnstile()
+        self.last_active = time.monotonic()
+        self._condition = None
+
+    @property
+    def condition(self):
+        # Created on first use so it belongs to the automation event loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def take_ticket(self):
+        ticket = self.next_ticket
+        self.next_ticket += 1
+        self.last_active = time.monotonic()
+        return ticket
+
+    def depth(self):
+        """Requests (chat and batch) that have a ticket but haven't finished running yet"""
+        return self.next_ticket - self.run.turn - len(self.run.skipped)
+
+    def idle_for(self):
+        """Seconds since the last request finished, or None while any request is queued or running"""
+        if self.run.turn < self.next_ticket:
+            return None
+        return time.monotonic() - self.last_active
+
+    def slot_for(self, ticket):
+        return get_slots()[ticket % self.slot_count]
+
+    async def wait_for_turn(self, predicate, deadline, waiting_for):
+        async with self.condition:
+            try:
+                await asyncio.wait_for(self.condition.wait_for(predicate), deadline.remaining())
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded(f"Deadline passed while waiting for {waiting_for}")
+
+    async def wait_upload_turn(self, ticket, deadline):
+        # With one slot this also waits for the previous request to finish running, like a plain queue
+        await self.wait_for_turn(lambda: self.upload.turn == ticket and self.run.turn > ticket - self.slot_count,
+                                 deadline, "a free prompt slot in the request queue")
+
+    async def wait_run_turn(self, ticket, deadline):
+        await self.wait_for_turn(lambda: self.run.turn == ticket, deadline, "AI Studio to finish earlier requests")
+
+    async def finish(self, ticket, stage=None):
+        """Let the next ticket through the given stage, or through both stages when stage is None"""
+        async with self.condition:
+            if stage in (None, 'upload'):
+                self.upload.done(ticket)
+            if stage in (None, 'run'):
+                self.run.done(ticket)
+            self.last_active = time.monotonic()
+            self.condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self):
+        """Hold both stages, after every earlier request has finished, e.g. to restart the browser"""
+        ticket = self.take_ticket()
+        try:
+            await self.wait_upload_turn(ticket, Deadline())
+            await self.wait_run_turn(ticket, Deadline())
+            yield
+        finally:
+            await self.finish(ticket)
+
+def get_slots():
+    """Prompt slots: the main CodeRequest file and prompt, then any extra ones from the pipeline config"""
+    slots = [{"transformed_request_file": TRANSFORMED_REQUEST_FILE, "aistudio_url": AISTUDIO_URL}]
+    slots.extend(config.get('pipeline', {}).get('extra_slots', []))
+    return slots
+
+# The slot count is fixed at startup, changing it while requests are in flight could reuse a busy slot
+automation_pipeline = AutomationPipeline(len(get_slots()))
+
+def write_request_file(transformed_data, slot):
+    """Save the transformed request to the slot's file, returning its path and size"""
+    abs_file_path = os.path.abspath(slot['transformed_request_file'])
+    prompt_file_content = json.dumps(transformed_data, indent=2)
+    with open(abs_file_path, 'w', encoding='utf-8') as f:
+        f.write(prompt_file_content)
+    return abs_file_path, len(prompt_file_content)
+
+async def attach_images(transformed_data, deadline, timings):
+    """Swap the request's inline images for Drive references, keeping them inline if uploading fails"""
+    if not config.get('attachments', {}).get('upload_to_drive', True):
+        return transformed_data
+    if not any("inlineImage" in chunk for chunk in transformed_data["chunkedPrompt"]["chunks"]):
+        return transformed_data
+    budget = deadline.budget_for('upload')
+    started = time.monotonic()
+    upload = automation.with_focus(automation.drive_page, automation.upload_attachments(transformed_data))
+    try:
+        return await asyncio.wait_for(upload, budget)
+    except Exception as e:
+        logging.warning(f"Could not upload images to Drive, sending them inline: {e!r}")
+        return transformed_data
+    finally:
+        timings['attachments'] = time.monotonic() - started
+
+def automation_unavailable():
+    """Check if the browser can take requests at all, logging why not"""
+    # Use the global automation instance, which should be initialized at startup
+    if not automation.is_browser_ready():
+        logging.error("Browser is not initialized. Please restart the server.")
+        return True
+    if not automation.is_authenticated:
+        # This could happen if the user was prompted to log in but hasn't yet.
+        logging.error("Not authenticated with Google. Please log in via the browser window.")
+        return True
+    return False
+
+async def process_request_with_automation(transformed_data, deadline=None, timings=None):
+    """Process the request using the global browser automation instance, with retries.
+    If a timings dict is given, it is filled with the seconds spent queued and in each stage."""
+    if deadline is None:
+        deadline = Deadline()
+    if timings is None:
+        timings = {}
+
+    ticket = automation_pipeline.take_ticket()
+    breaker_key = None
+    trial = False
+    queued_at = time.monotonic()
+    try:
+        # Anything raised after taking the ticket must still finish it, or every later request would wait forever
+        slot = automation_pipeline.slot_for(ticket)
+        breaker_key = circuit_breaker.key_for(slot)
+        await automation_pipeline.wait_upload_turn(ticket, deadline)
+        timings['queue'] = time.monotonic() - queued_at
+        # Drop requests that expired while queued before they ever touch the browser
+        if deadline.expired():
+            raise DeadlineExceeded("Deadline passed while waiting in the request queue")
+        if automation_unavailable():
+            return None # No point in retrying
+        # Fail fast instead of uploading into a quota that is known to be used up
+        trial = circuit_breaker.before_request(breaker_key)
+
+        # Upload stage: overlaps with the previous request's generation when there are spare slots
+        transformed_data = await attach_images(transformed_data, deadline, timings)
+        abs_file_path, prompt_size = write_request_file(transformed_data, slot)
+        uploaded = False
+        try:
+            upload = automation.with_focus(automation.drive_page, automation.upload_to_drive(abs_file_path))
+            await run_stage('upload', upload, deadline, prompt_size, timings)
+            uploaded = True
+        except (DeadlineExceeded, QuotaExceeded):
+            raise
+        except Exception as e:
+            logging.error(f"Error uploading request, will retry once it's this request's turn to run: {e}")
+        await automation_pipeline.finish(ticket, 'upload')
+
+        # Run stage: strictly one request at a time, in the order they were uploaded
+        await automation_pipeline.wait_run_turn(ticket, deadline)
+        return await run_automation_attempts(abs_file_path, prompt_size, slot, uploaded, deadline, timings)
+    finally:
+        if trial:
+            circuit_breaker.end_trial(breaker_key)
+        await automation_pipeline.finish(ticket)
+
+async def run_automation_attempts(abs_file_path, prompt_size, slot, uploaded, deadline, timings):
+    """Run and copy the request, re-uploading and retrying while the deadline still allows a full attempt"""
     max_retries = 3
     retry_delay = 5  # seconds
 
     for attempt in range(max_retries):
         try:
-            # Use the global automation instance, which should be initialized at startup
-            if not automation.is_browser_ready():
-                logging.error("Browser is not initialized. Please restart the server.")
-                return None # No point in retrying
-
-            if not automation.is_authenticated:
-                # This could happen if the user was prompted to log in but hasn't yet.
-                logging.error("Not authenticated with Google. Please log in via the browser window.")
+            if automation_unavailable():
                 return None # No point in retrying
             
-            # Save transformed request to file
-            abs_file_path = os.path.abspath(TRANSFORMED_REQUEST_FILE)
-            with open(abs_file_path, 'w', encoding='utf-8') as f:
-                f.write(json.dumps(transformed_data, indent=2))
-            
-            # Upload to Google Drive
-            await automation.upload_to_drive(abs_file_path)
+            # Upload to Google Drive (already done in the upload stage for the first attempt)
+            if not uploaded:
+                upload = automation.with_focus(automation.drive_page, automation.upload_to_drive(abs_file_path))
+                await run_stage('upload', upload, deadline, prompt_size, timings)
+                uploaded = True
             
             # Run AI Studio prompt
-            await automation.run_ai_studio_prompt()
+            run = automation.run_ai_studio_prompt(prompt_size, slot['aistudio_url'])
+            await run_stage('run', run, deadline, prompt_size, timings)
+            await automation.check_for_page_error()
             
             # Copy response
-            response_content = await automation.copy_response()
+            copy = automation.with_focus(automation.page, automation.copy_response())
+            response_content = await run_stage('copy', copy, deadline, prompt_size, timings)
 
             # Check if the copy operation itself returned a string indicating an error
             if isinstance(response_content, str) and response_content.startswith("[Error:"):
                 raise Exception(f"Copy response operation failed: {response_content}")
+            if not response_content or not response_content.strip():
+                raise AIStudioError("AI Studio returned an empty response")
             
+            circuit_breaker.record_result(circuit_breaker.key_for(slot))
             return response_content # Success
             
+        except DeadlineExceeded:
+            raise
+        except QuotaExceeded as e:
+            # Retrying into a quota only burns more time, open the breaker and fail fast instead
+            e.retry_after = circuit_breaker.record_quota_error(circuit_breaker.key_for(slot), str(e))
+            raise
         except Exception as e:
             logging.error(f"Error in automation process (attempt {attempt + 1}/{max_retries}): {e}")
+            uploaded = False
+            if attempt < max_retries - 1 and not deadline.can_fit(retry_delay):
+                # A retry that can't finish in time would only hold up the queue
+                raise DeadlineExceeded(f"Request failed and there is not enough time left to retry: {e}")
             if attempt < max_retries - 1:
                 logging.info(f"Retrying in {retry_delay} seconds...")
                 await asyncio.sleep(retry_delay)
@@ -716,14 +1945,175 @@ async def process_request_with_automation(transformed_data):
                 return None # Indicate final failure
 
 
+# --- Traffic Recording ---
+class TrafficRecorder:
+    """Appends every incoming chat completion request, with its arrival time and timings, to a JSONL file
+    so real traffic can be replayed later with replay_traffic.py"""
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    @property
+    def settings(self):
+        return config.get('recording', {})
+
+    @property
+    def enabled(self):
+        return self.settings.get('enabled', False)
+
+    def record(self, arrival, request_data, headers, status, timings):
+        entry = {
+            "arrival": arrival,
+            "recorded_at": datetime.fromtimestamp(arrival).isoformat(),
+            "request": request_data,
+            "headers": headers,
+            "status": status,
+            "timings": timings
+        }
+        line = json.dumps(entry) + "\n"
+        try:
+            with self.lock:
+                with open(self.settings.get('file', 'requests.jsonl'), 'a', encoding='utf-8') as f:
+                    f.write(line)
+        except OSError as e:
+            logging.warning(f"Could not record request: {e}")
+
+traffic_recorder = TrafficRecorder()
+
+# --- Load Reporting ---
+class LoadTracker:
+    """Requests in flight and recent latency, reported on /health so a gateway can route between servers"""
+    def __init__(self, smoothing=0.3):
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.latency = None
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def finish(self, seconds, succeeded):
+        with self.lock:
+            self.in_flight -= 1
+            if succeeded:
+                if self.latency is None:
+                    self.latency = seconds
+                else:
+                    self.latency += self.smoothing * (seconds - self.latency)
+
+    def snapshot(self):
+        with self.lock:
+            return {"queue_depth": self.in_flight, "recent_latency": self.latency}
+
+load_tracker = LoadTracker()
+
 # --- API Endpoint ---
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
+    arrival = time.time()
+    request_start = time.monotonic()
+    timings = {}
+    request_data = request.get_json(silent=True)
+    headers = {name: request.headers[name] for name in ('X-Request-Timeout',) if name in request.headers}
+    load_tracker.start()
+    try:
+        response = app.make_response(handle_chat_completion(timings))
+    except Exception:
+        load_tracker.finish(time.monotonic() - request_start, succeeded=False)
+        raise
+
+    def finish_request():
+        # Streaming responses are only done once the body has been sent, so this runs when the response closes
+        elapsed = time.monotonic() - request_start
+        load_tracker.finish(elapsed, succeeded=response.status_code == 200 and 'error' not in timings)
+        if traffic_recorder.enabled:
+            timings['total'] = elapsed
+            traffic_recorder.record(arrival, request_data, headers, response.status_code, timings)
+
+    response.call_on_close(finish_request)
+    return response
+
+@app.route('/health', methods=['GET'])
+def health():
+    """Readiness and load of this server, used by gateway.py for routing"""
+    quota_wait = circuit_breaker.all_open([circuit_breaker.key_for(slot) for slot in get_slots()])
+    ready = automation.is_browser_ready() and automation.is_authenticated and quota_wait is None
+    payload = {"status": "ok" if ready else "unavailable",
+               "browser_ready": automation.is_browser_ready(),
+               "authenticated": automation.is_authenticated,
+               "circuit_breakers": circuit_breaker.snapshot()}
+    payload.update(load_tracker.snapshot())
+    # Batch items go through the pipeline without an HTTP request of their own, so count them too
+    payload["queue_depth"] = max(payload["queue_depth"], automation_pipeline.depth())
+    return jsonify(payload), 200 if ready else 503
+
+def handle_chat_completion(timings):
     try:
         request_data = request.get_json()
         is_streaming = request_data.get("stream", False)
+
+        try:
+            deadline = get_request_deadline(request_data)
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": {
+                "message": f"Invalid request timeout: {e}",
+                "type": "invalid_request_error",
+                "param": "timeout",
+                "code": "invalid_timeout"
+            }}), 400
         
-        transformed_data = transform_to_gemini_format(request_data)
+        try:
+            transformed_data = transform_to_gemini_format(request_data)
+        except AttachmentError as e:
+            return jsonify({"error": {
+                "message": str(e),
+                "type": "invalid_request_error",
+                "param": "messages",
+                "code": "invalid_image_url"
+            }}), 400
+
+        # Reject prompts the model can't take before spending minutes on the upload and run
+        prompt_tokens = estimate_prompt_tokens(transformed_data)
+        context_limit = get_context_limit()
+        if context_limit is not None and prompt_tokens > context_limit:
+            logging.warning(f"Rejected request with an estimated {prompt_tokens} prompt tokens (limit {context_limit})")
+            return jsonify({"error": {
+                "message": f"This model's maximum context length is {context_limit} tokens. However, your messages resulted in {prompt_tokens} tokens. Please reduce the length of the messages.",
+                "type": "invalid_request_error",
+                "param": "messages",
+                "code": "context_length_exceeded"
+            }}), 400
+
+        response_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model_name = "ai-studio-automated-v1"
+        include_usage = (request_data.get("stream_options") or {}).get("include_usage", False)
+
+        # Answer near-duplicates of an earlier prompt without touching the browser
+        fingerprint = None
+        if similarity_cache.enabled_for(request.path):
+            fingerprint = similarity_cache.fingerprint(transformed_data)
+            cached = similarity_cache.lookup(fingerprint)
+            if cached is not None:
+                ai_response_content, similarity = cached
+                logging.info(f"Answered from the similarity cache (similarity {similarity:.3f})")
+                timings['cache'] = 'hit'
+                if is_streaming:
+                    cached_future = concurrent.futures.Future()
+                    cached_future.set_result(ai_response_content)
+                    return Response(stream_generator(response_id, model_name, cached_future, prompt_tokens, include_usage, timings),
+                                    mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+                return completion_response(build_completion(response_id, model_name, ai_response_content, prompt_tokens), timings)
+
+        def store_in_cache(content):
+            if fingerprint is not None:
+                similarity_cache.store(fingerprint, content)
+
+        # Every slot is paused after hitting a quota, so don't even queue the request
+        retry_after = circuit_breaker.all_open([circuit_breaker.key_for(slot) for slot in get_slots()])
+        if circuit_breaker.settings.get('enabled', True) and retry_after is not None:
+            return quota_error_response(QuotaExceeded(
+                f"AI Studio quota reached, requests are paused for {retry_after:.0f} more seconds", retry_after=retry_after))
+
         pretty_request = json.dumps(transformed_data, indent=2)
 
         print("="*50)
@@ -734,48 +2124,739 @@ def chat_completions():
         print("--- Original Request ---")
         print(json.dumps(request_data, indent=2))
         
-        # Display, copy, and save the transformed request
+        # Display and save the transformed request. It isn't copied to the clipboard anymore: with requests
+        # pipelined, that copy could land between another request's "Copy markdown" click and its paste.
         print("\n--- Transformed Request (shown in UI) ---")
         print(pretty_request)
-        pyperclip.copy(pretty_request)
         
         print(f"\n[INFO] Transformed request saved to '{TRANSFORMED_REQUEST_FILE}'")
         print("[INFO] Starting automated AI Studio process...")
+
+        if is_streaming:
+            # Commit the response now and keep the connection alive while the request is queued and running
+            automation_future = automation_runner.submit_coroutine(
+                process_request_with_automation(transformed_data, deadline, timings)
+            )
+            return Response(stream_generator(response_id, model_name, automation_future, prompt_tokens, include_usage, timings,
+                                             on_content=store_in_cache),
+                            mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
         
         # Process request using the centralized automation runner
-        ai_response_content = automation_runner.run_coroutine(
-            process_request_with_automation(transformed_data)
-        )
+        try:
+            ai_response_content = automation_runner.run_coroutine(
+                process_request_with_automation(transformed_data, deadline, timings)
+            )
+        except DeadlineExceeded as e:
+            logging.error(f"Request deadline exceeded: {e}")
+            return jsonify({"error": deadline_error(e)}), 504
+        except QuotaExceeded as e:
+            logging.error(f"Request hit the AI Studio quota: {e}")
+            return quota_error_response(e)
 
         if ai_response_content is None:
             # Automation failed after all retries. Error is logged to the terminal.
             # Return a server error response instead of putting error in content.
-            return jsonify({"error": {
-                "message": "Request failed after multiple attempts. Please check the server logs for more details.",
-                "type": "server_error",
-                "code": "automation_failed"
-            }}), 500
-
-        response_id = f"chatcmpl-{uuid.uuid4().hex}"
-        model_name = "ai-studio-automated-v1"
+            return jsonify({"error": AUTOMATION_FAILED_ERROR}), 500
 
-        if is_streaming:
-            print("\n--- SENDING STREAMING RESPONSE ---")
-            return Response(stream_generator(response_id, model_name, ai_response_content), mimetype='text/event-stream')
-        else:
-            response_payload = {
-                "id": response_id, "object": "chat.completion", "created": int(time.time()), "model": model_name,
-                "choices": [{"index": 0, "message": {"role": "assistant", "content": ai_response_content}, "finish_reason": "stop"}],
-                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-            }
-            print("\n--- SENDING NON-STREAMING RESPONSE ---")
-            print(json.dumps(response_payload, indent=2))
-            return jsonify(response_payload)
+        store_in_cache(ai_response_content)
+        response_payload = build_completion(response_id, model_name, ai_response_content, prompt_tokens)
+        print("\n--- SENDING NON-STREAMING RESPONSE ---")
+        print(f"Response content: {len(ai_response_content)} characters")
+        return completion_response(response_payload, timings)
 
     except Exception as e:
         logging.error(f"An unexpected error occurred in the chat completions endpoint: {e}", exc_info=True)
         return jsonify({"error": "An unexpected server error occurred."}), 500
 
+@app.route('/admin/similarity-cache', methods=['GET'])
+def similarity_cache_stats():
+    """Size, hit rate and hit quality of the near-duplicate prompt cache"""
+    stats = similarity_cache.snapshot()
+    stats["enabled"] = similarity_cache.settings.get('enabled', False)
+    return jsonify(stats)
+
+@app.route('/admin/timeouts', methods=['GET'])
+def adaptive_timeouts():
+    """Show the learned stage durations and the timeouts currently derived from them"""
+    derived = {}
+    bucket_start = 0
+    for limit, bucket in PROMPT_SIZE_BUCKETS:
+        derived[bucket] = {name: get_timeout(name, bucket_start) for name in TIMEOUT_STAGES}
+        bucket_start = limit
+    return jsonify({
+        "enabled": ADAPTIVE_TIMEOUTS.get('enabled', False),
+        "configured": {name: config['timeouts'][name] for name in TIMEOUT_STAGES},
+        "derived": derived,
+        "stages": stage_stats.snapshot()
+    })
+
+# --- Batch Jobs ---
+BATCH_ENDPOINTS = ('/v1/chat/completions',)
+BATCH_ACTIVE_STATUSES = ('validating', 'in_progress', 'finalizing', 'cancelling')
+FILE_ID_PATTERN = re.compile(r"^file-[0-9a-f]{32}$")
+BATCH_ID_PATTERN = re.compile(r"^batch_[0-9a-f]{32}$")
+
+class BatchManager:
+    """OpenAI style files and batches, run in the background one batch at a time.
+
+    Uploaded files and their metadata are kept in the batch directory, next to one state file per batch.
+    Each item's result is appended to the batch's output (or error) file as soon as it finishes, so after
+    a crash or restart the batch carries on with the items that don't have a result yet. Identical items
+    are only run once, and a few items are kept queued at a time so every prompt slot stays busy."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.batches = {}  # batch id -> batch object
+        self.queue = queue.Queue()
+        self.worker = None
+        self.quota_backoff_until = 0  # Own pause after a quota error, used when the circuit breaker is off
+
+    @property
+    def settings(self):
+        return config.get('batches', {})
+
+    @property
+    def directory(self):
+        return self.settings.get('directory', 'batches')
+
+    @staticmethod
+    def save_json(path, data):
+        """Write atomically so a crash never leaves a half written file"""
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+        os.replace(temp_path, path)
+
+    # Files
+    def file_path(self, file_id):
+        return os.path.join(self.directory, 'files', f"{file_id}.jsonl")
+
+    def create_file(self, data, filename, purpose):
+        file_id = f"file-{uuid.uuid4().hex}"
+        os.makedirs(os.path.join(self.directory, 'files'), exist_ok=True)
+        with open(self.file_path(file_id), 'wb') as f:
+            f.write(data)
+        file_object = {"id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+                       "filename": filename, "purpose": purpose}
+        self.save_json(os.path.join(self.directory, 'files', f"{file_id}.json"), file_object)
+        return file_object
+
+    def get_file(self, file_id):
+        if not FILE_ID_PATTERN.match(file_id):
+            return None
+        try:
+            with open(os.path.join(self.directory, 'files', f"{file_id}.json"), 'r', encoding='utf-8') as f:
+                file_object = json.load(f)
+            # Output files grow while their batch runs
+            file_object["bytes"] = os.path.getsize(self.file_path(file_id))
+        except (OSError, json.JSONDecodeError):
+            return None
+        return file_object
+
+    # Batches
+    def batch_path(self, batch_id):
+        return os.path.join(self.directory, f"{batch_id}.json")
+
+    def create_batch(self, input_file_id, endpoint, metadata):
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        now = int(time.time())
+        output_file = self.create_file(b"", f"{batch_id}_output.jsonl", "batch_output")
+        error_file = self.create_file(b"", f"{batch_id}_error.jsonl", "batch_output")
+        batch = {
+            "id": batch_id, "object": "batch", "endpoint": endpoint, "errors": None,
+            "input_file_id": input_file_id, "completion_window": "24h", "status": "validating",
+            "output_file_id": output_file["id"], "error_file_id": error_file["id"],
+            "created_at": now, "in_progress_at": None, "expires_at": now + 24 * 3600, "finalizing_at": None,
+            "completed_at": None, "failed_at": None, "expired_at": None, "cancelling_at": None, "cancelled_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "skipped": {"cached": 0, "duplicates": 0},
+            "metadata": metadata
+        }
+        with self.lock:
+            self.batches[batch_id] = batch
+            self.save_json(self.batch_path(batch_id), batch)
+        self.queue.put(batch_id)
+        return dict(batch)
+
+    def get_batch(self, batch_id):
+        with self.lock:
+            batch = self.batches.get(batch_id)
+            return json.loads(json.dumps(batch)) if batch is not None else None
+
+    def list_batches(self, limit=20):
+        with self.lock:
+            batches = sorted(self.batches.values(), key=lambda batch: -batch["created_at"])[:limit]
+            return json.loads(json.dumps(batches))
+
+    def update(self, batch_id, **changes):
+        """Change a batch and checkpoint it to disk"""
+        with self.lock:
+            batch = self.batches[batch_id]
+            batch.update(changes)
+            try:
+                self.save_json(self.batch_path(batch_id), batch)
+            except OSError as e:
+                logging.warning(f"Could not save batch {batch_id}: {e}")
+            return dict(batch)
+
+    def cancel(self, batch_id):
+        with self.lock:
+            status = self.batches[batch_id]["status"]
+        if status in ('validating', 'in_progress'):
+            return self.update(batch_id, status='cancelling', cancelling_at=int(time.time()))
+        return self.get_batch(batch_id)
+
+    def stop_reason(self, batch_id):
+        """Status the batch should end with instead of completed, or None to keep going"""
+        with self.lock:
+            batch = self.batches[batch_id]
+            if batch["status"] == 'cancelling':
+                return 'cancelled'
+            if time.time() > batch["expires_at"]:
+                return 'expired'
+        return None
+
+    def start(self):
+        """Pick up batches left unfinished by a previous run, then start the worker"""
+        os.makedirs(self.directory, exist_ok=True)
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.json') or not BATCH_ID_PATTERN.match(name[:-len('.json')]):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), 'r', encoding='utf-8') as f:
+                    batch = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logging.warning(f"Could not load batch {name}: {e}")
+                continue
+            self.batches[batch["id"]] = batch
+            if batch["status"] in BATCH_ACTIVE_STATUSES:
+                logging.info(f"Resuming batch {batch['id']}")
+                self.queue.put(batch["id"])
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def run(self):
+        while True:
+            batch_id = self.queue.get()
+            try:
+                self.process(batch_id)
+            except Exception as e:
+                logging.error(f"Batch {batch_id} failed: {e}", exc_info=True)
+                self.update(batch_id, status='failed', failed_at=int(time.time()),
+                            errors={"object": "list", "data": [{"code": "batch_failed", "message": str(e), "line": None}]})
+
+    # Processing
+    def read_items(self, batch):
+        """Parse and validate the input file, returning its items and a list of problems found"""
+        items = []
+        errors = []
+        custom_ids = set()
+        with open(self.file_path(batch["input_file_id"]), 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError as e:
+                    errors.append({"code": "invalid_json_line", "message": f"Invalid JSON: {e}", "line": line_number})
+                    continue
+                if not isinstance(item, dict) or not isinstance(item.get('body'), dict) \
+                        or not isinstance(item['body'].get('messages'), list):
+                    errors.append({"code": "invalid_request", "message": "Each line needs a body with messages", "line": line_number})
+                elif item.get('url') != batch["endpoint"] or item.get('method', 'POST') != 'POST':
+                    errors.append({"code": "mismatched_endpoint",
+                                   "message": f"Only POST {batch['endpoint']} requests can be in this batch", "line": line_number})
+                elif item.get('custom_id') is None or item['custom_id'] in custom_ids:
+                    errors.append({"code": "duplicate_custom_id", "message": "Each line needs a unique custom_id", "line": line_number})
+                else:
+                    custom_ids.add(item['custom_id'])
+                    items.append(item)
+        if not items and not errors:
+            errors.append({"code": "empty_file", "message": "The input file has no requests", "line": None})
+        return items, errors
+
+    def finished_custom_ids(self, batch):
+        """Items that already have a result, read back from the output files after a restart"""
+        finished = {"completed": set(), "failed": set()}
+        for key, file_id in (("completed", batch["output_file_id"]), ("failed", batch["error_file_id"])):
+            try:
+                with open(self.file_path(file_id), 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            finished[key].add(json.loads(line)["custom_id"])
+                        except (json.JSONDecodeError, KeyError, TypeError):
+                            pass  # A line cut short by a crash, that item runs again
+            except FileNotFoundError:
+                pass
+        return finished
+
+    def write_result(self, batch, item, content=None, prompt_tokens=0, error=None):
+        """Append one item's result to the output or error file, synced so it survives a crash"""
+        request_id = f"chatcmpl-{uuid.uuid4().hex}"
+        line = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": item["custom_id"], "response": None, "error": None}
+        if error is None:
+            line["response"] = {"status_code": 200, "request_id": request_id,
+                                "body": build_completion(request_id, "ai-studio-automated-v1", content, prompt_tokens)}
+            file_id = batch["output_file_id"]
+        else:
+            line["error"] = {"code": error["code"], "message": error["message"]}
+            file_id = batch["error_file_id"]
+        with open(self.file_path(file_id), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(line) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def quota_pause(self):
+        """Seconds until some prompt slot is out of its quota pause, or None if one can take requests now"""
+        waits = []
+        if circuit_breaker.settings.get('enabled', True):
+            waits.append(circuit_breaker.all_open([circuit_breaker.key_for(slot) for slot in get_slots()]))
+        if self.quota_backoff_until > time.monotonic():
+            waits.append(self.quota_backoff_until - time.monotonic())
+        waits = [wait for wait in waits if wait is not None]
+        return max(waits) if waits else None
+
+    def process(self, batch_id):
+        batch = self.get_batch(batch_id)
+        stop = self.stop_reason(batch_id)
+        if stop is not None:
+            self.update(batch_id, status=stop, **{f"{stop}_at": int(time.time())})
+            return
+
+        try:
+            items, errors = self.read_items(batch)
+        except OSError as e:
+            items, errors = [], [{"code": "invalid_input_file", "message": str(e), "line": None}]
+        if errors:
+            logging.error(f"Batch {batch_id} has an invalid input file ({len(errors)} problems)")
+            self.update(batch_id, status='failed', failed_at=int(time.time()), errors={"object": "list", "data": errors})
+            return
+
+        finished = self.finished_custom_ids(batch)
+        counts = {"total": len(items), "completed": len(finished["completed"]), "failed": len(finished["failed"])}
+        batch = self.update(batch_id, status='in_progress', in_progress_at=batch["in_progress_at"] or int(time.time()),
+                            request_counts=counts)
+        skipped = dict(batch["skipped"])
+        use_cache = similarity_cache.enabled_for('/v1/batches')
+        context_limit = get_context_limit()
+        logging.info(f"Batch {batch_id}: {counts['total']} requests, {counts['completed'] + counts['failed']} already done")
+
+        # Group identical requests so each distinct prompt only goes through AI Studio once. Finished items
+        # are grouped too, so the duplicate count comes out the same however many times the batch resumes.
+        groups = OrderedDict()
+        skipped["duplicates"] = 0
+        for item in items:
+            already_done = item["custom_id"] in finished["completed"] or item["custom_id"] in finished["failed"]
+            try:
+                transformed_data = transform_to_gemini_format(item["body"])
+            except Exception as e:
+                if not already_done:
+                    self.write_result(batch, item, error={"code": "invalid_request", "message": f"Could not convert request: {e}"})
+                    counts["failed"] += 1
+                continue
+            key = hashlib.sha256(json.dumps(transformed_data, sort_keys=True).encode('utf-8')).hexdigest()
+            if key in groups:
+                skipped["duplicates"] += 1
+            else:
+                groups[key] = {"transformed_data": transformed_data, "items": [], "quota_hits": 0}
+            if not already_done:
+                groups[key]["items"].append(item)
+        self.update(batch_id, request_counts=dict(counts), skipped=dict(skipped))
+
+        def finish_group(group, content=None, error=None):
+            prompt_tokens = estimate_prompt_tokens(group["transformed_data"])
+            for item in group["items"]:
+                self.write_result(batch, item, content, prompt_tokens, error)
+                counts["failed" if error else "completed"] += 1
+            self.update(batch_id, request_counts=dict(counts), skipped=dict(skipped))
+
+        # A few more requests than slots are kept queued so the next upload is always ready to go,
+        # without queueing the whole batch ahead of interactive requests
+        concurrency = self.settings.get('concurrency') or automation_pipeline.slot_count + 1
+        pending = deque(group for group in groups.values() if group["items"])
+        in_flight = {}  # future -> group
+        stop = None
+        while pending or in_flight:
+            stop = stop or self.stop_reason(batch_id)
+            if stop is not None:
+                for future in in_flight:
+                    future.cancel()
+                break
+
+            paused_for = None
+            while pending and len(in_flight) < concurrency:
+                paused_for = self.quota_pause()
+                if paused_for is not None:
+                    break
+                group = pending.popleft()
+                transformed_data = group["transformed_data"]
+                prompt_tokens = estimate_prompt_tokens(transformed_data)
+                if context_limit is not None and prompt_tokens > context_limit:
+                    finish_group(group, error={"code": "context_length_exceeded",
+                                               "message": f"{prompt_tokens} prompt tokens is over the {context_limit} token limit"})
+                    continue
+                if use_cache:
+                    group["fingerprint"] = similarity_cache.fingerprint(transformed_data)
+                    cached = similarity_cache.lookup(group["fingerprint"])
+                    if cached is not None:
+                        skipped["cached"] += len(group["items"])
+                        finish_group(group, content=cached[0])
+                        continue
+                future = automation_runner.submit_coroutine(process_request_with_automation(transformed_data))
+                in_flight[future] = group
+
+            if not in_flight:
+                if pending and paused_for is not None:
+                    # Every slot hit its quota, wait for the pause instead of failing the rest of the batch
+                    logging.info(f"Batch {batch_id} paused for {paused_for:.0f}s by the AI Studio quota")
+                    time.sleep(min(paused_for, 60))
+                continue
+
+            done, _ = concurrent.futures.wait(in_flight, timeout=60, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                group = in_flight.pop(future)
+                try:
+                    content = future.result()
+                except QuotaExceeded as e:
+                    group["quota_hits"] += 1
+                    if group["quota_hits"] >= self.settings.get('max_quota_retries', 5):
+                        logging.error(f"Batch {batch_id} request hit the AI Studio quota {group['quota_hits']} times, giving up: {e}")
+                        finish_group(group, error=quota_error(e))
+                        continue
+                    # Goes back to the front of the queue and runs once the quota pause is over
+                    backoff = e.retry_after or circuit_breaker.settings.get('cooldown_seconds', 300)
+                    self.quota_backoff_until = max(self.quota_backoff_until, time.monotonic() + backoff)
+                    logging.warning(f"Batch {batch_id} request hit the AI Studio quota, will retry in {backoff:.0f}s: {e}")
+                    pending.appendleft(group)
+                    continue
+                except Exception as e:
+                    logging.error(f"Batch {batch_id} request failed: {e}")
+                    content = None
+                if content is None:
+                    finish_group(group, error=AUTOMATION_FAILED_ERROR)
+                    continue
+                if group.get("fingerprint") is not None:
+                    similarity_cache.store(group["fingerprint"], content)
+                finish_group(group, content=content)
+
+        now = int(time.time())
+        if stop is not None:
+            self.update(batch_id, status=stop, **{f"{stop}_at": now})
+        else:
+            self.update(batch_id, status='completed', finalizing_at=now, completed_at=now)
+        logging.info(f"Batch {batch_id} {stop or 'completed'}: {counts['completed']} completed, {counts['failed']} failed, "
+                     f"{skipped['duplicates']} duplicates and {skipped['cached']} cached not run")
+
+batch_manager = BatchManager()
+
+def invalid_request(message, param=None, status=400):
+    return jsonify({"error": {"message": message, "type": "invalid_request_error", "param": param, "code": None}}), status
+
+@app.route('/v1/files', methods=['POST'])
+def upload_file():
+    uploaded = request.files.get('file')
+    purpose = request.form.get('purpose')
+    if uploaded is None:
+        return invalid_request("Missing file", "file")
+    if purpose != 'batch':
+        return invalid_request("Only files with purpose 'batch' are supported", "purpose")
+    return jsonify(batch_manager.create_file(uploaded.read(), uploaded.filename or "input.jsonl", purpose))
+
+@app.route('/v1/files/<file_id>', methods=['GET'])
+def get_file(file_id):
+    file_object = batch_manager.get_file(file_id)
+    if file_object is None:
+        return invalid_request(f"No such file: {file_id}", status=404)
+    return jsonify(file_object)
+
+@app.route('/v1/files/<file_id>/content', methods=['GET'])
+def get_file_content(file_id):
+    if batch_manager.get_file(file_id) is None:
+        return invalid_request(f"No such file: {file_id}", status=404)
+    return flask.send_file(os.path.abspath(batch_manager.file_path(file_id)), mimetype='application/jsonl')
+
+@app.route('/v1/batches', methods=['POST'])
+def create_batch():
+    request_data = request.get_json(silent=True) or {}
+    input_file_id = request_data.get('input_file_id')
+    endpoint = request_data.get('endpoint')
+    if not isinstance(input_file_id, str) or batch_manager.get_file(input_file_id) is None:
+        return invalid_request(f"No such file: {input_file_id}", "input_file_id")
+    if endpoint not in BATCH_ENDPOINTS:
+        return invalid_request(f"Unsupported endpoint, use one of: {', '.join(BATCH_ENDPOINTS)}", "endpoint")
+    if request_data.get('completion_window', '24h') != '24h':
+        return invalid_request("completion_window must be '24h'", "completion_window")
+    return jsonify(batch_manager.create_batch(input_file_id, endpoint, request_data.get('metadata')))
+
+@app.route('/v1/batches', methods=['GET'])
+def list_batches():
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return invalid_request("limit must be a number", "limit")
+    batches = batch_manager.list_batches(limit)
+    return jsonify({"object": "list", "data": batches, "has_more": False,
+                    "first_id": batches[0]["id"] if batches else None, "last_id": batches[-1]["id"] if batches else None})
+
+@app.route('/v1/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    batch = batch_manager.get_batch(batch_id)
+    if batch is None:
+        return invalid_request(f"No such batch: {batch_id}", status=404)
+    return jsonify(batch)
+
+@app.route('/v1/batches/<batch_id>/cancel', methods=['POST'])
+def cancel_batch(batch_id):
+    if batch_manager.get_batch(batch_id) is None:
+        return invalid_request(f"No such batch: {batch_id}", status=404)
+    return jsonify(batch_manager.cancel(batch_id))
+
+# --- Drive Folder Maintenance ---
+ATTACHMENT_NAME_PATTERN = re.compile(r"^[0-9a-f]{32}\.\w+$")
+PROMPT_ID_PATTERN = re.compile(r"/prompts/([\w-]+)")
+
+class DriveMaintenance:
+    """Keeps the Drive folder small, so the folder page every upload loads stays fast.
+
+    While no requests are queued or running it trashes extra copies of the prompt files (Drive's
+    "CodeRequest (1)" and copies that aren't the prompt AI Studio opens), old image attachments, and
+    old versions of the prompt files, and times loading the folder before and after."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_run = None
+        self.reports = deque(maxlen=20)
+
+    @property
+    def settings(self):
+        return config.get('drive_maintenance', {})
+
+    def classify(self, files):
+        """Split the folder's files into prompt files to keep, duplicates of them, and our image attachments"""
+        prompts, duplicates, attachments = [], [], []
+        listed_ids = {file["id"] for file in files}
+        prompt_ids = set()
+        slots = []
+        for slot in get_slots():
+            name = os.path.basename(slot['transformed_request_file'])
+            match = PROMPT_ID_PATTERN.search(slot['aistudio_url'])
+            prompt_id = match.group(1) if match else None
+            if prompt_id is not None:
+                prompt_ids.add(prompt_id)
+            # Unless the prompt AI Studio opens is found by its id, there's no telling which copy to keep
+            if prompt_id in listed_ids:
+                slots.append((name, re.compile(rf"^{re.escape(name)} \(\d+\)$")))
+
+        for file in files:
+            if file["id"] in prompt_ids:
+                # Whatever it's called, the file a slot's prompt URL points at is never deleted
+                prompts.append(file)
+            elif ATTACHMENT_NAME_PATTERN.match(file["name"]):
+                attachments.append(file)
+            elif any(file["name"] == name or copy_pattern.match(file["name"]) for name, copy_pattern in slots):
+                duplicates.append(file)
+        return prompts, duplicates, attachments
+
+    def attachments_to_trash(self, attachments, file_count):
+        """Attachments older than the age limit, then the oldest ones until the folder is under max_files.
+        Only images this server uploaded (the ones in its registry) are considered, an image that only looks
+        like one may belong to another server on the same account or to the user."""
+        max_age = self.settings.get('attachment_max_age_days', 7) * 24 * 3600
+        max_files = self.settings.get('max_files', 50)
+        ours = [(attachment_registry.uploaded_at(file["id"]), file) for file in attachments]
+        ours = sorted(((uploaded_at, file) for uploaded_at, file in ours if uploaded_at is not None),
+                      key=lambda entry: entry[0])
+        to_trash = []
+        for uploaded_at, file in ours:
+            if time.time() - uploaded_at > max_age or file_count - len(to_trash) > max_files:
+                to_trash.append(file)
+        return to_trash
+
+    async def run(self):
+        """One maintenance pass, holding the pipeline so no upload happens meanwhile"""
+        settings = self.settings
+        report = {"started_at": datetime.now().isoformat(), "deleted": {"duplicates": 0, "attachments": 0, "revisions": 0},
+                  "errors": []}
+        async with automation_pipeline.exclusive():
+            started = time.monotonic()
+            async with automation.focus_lock:
+                await automation.drive_page.bring_to_front()
+                report["load_seconds_before"] = await automation.load_drive_folder()
+                files = await automation.list_drive_files()
+                report["files_before"] = len(files)
+                prompts, duplicates, attachments = self.classify(files)
+
+                deletions_left = settings.get('max_deletions', 25)
+                to_trash = [("duplicates", file) for file in duplicates]
+                to_trash.extend(("attachments", file) for file in
+                                self.attachments_to_trash(attachments, len(files) - len(duplicates)))
+                for kind, file in to_trash[:deletions_left]:
+                    if time.monotonic() - started > settings.get('max_seconds', 120):
+                        report["errors"].append("Stopped early, out of time")
+                        break
+                    try:
+                        await automation.trash_drive_file(file["id"])
+                        report["deleted"][kind] += 1
+                        if kind == "attachments":
+                            attachment_registry.remove_file(file["id"])
+                    except Exception as e:
+                        report["errors"].append(f"Could not trash {file['name']}: {e}")
+
+                if settings.get('prune_revisions', True):
+                    stop_at = started + settings.get('max_seconds', 120)
+                    for file in prompts:
+                        # Versions count against the same deletion limit as files
+                        deletions_left = settings.get('max_deletions', 25) - sum(report["deleted"].values())
+                        if deletions_left <= 0 or time.monotonic() >= stop_at:
+                            break
+                        deleted, error = await automation.prune_drive_revisions(
+                            file["id"], settings.get('keep_revisions', 10), deletions_left, stop_at)
+                        report["deleted"]["revisions"] += deleted
+                        if error is not None:
+                            report["errors"].append(f"Could not prune versions of {file['name']}: {error}")
+
+                report["load_seconds_after"] = await automation.load_drive_folder()
+                report["files_after"] = len(await automation.list_drive_files())
+            report["seconds"] = time.monotonic() - started
+
+        logging.info(f"Drive maintenance: {report['files_before']} -> {report['files_after']} files, folder load "
+                     f"{report['load_seconds_before']:.2f}s -> {report['load_seconds_after']:.2f}s, deleted {report['deleted']}")
+        with self.lock:
+            self.reports.append(report)
+        return report
+
+    def run_now(self):
+        self.last_run = time.monotonic()
+        try:
+            return automation_runner.run_coroutine(self.run())
+        except Exception as e:
+            logging.error(f"Drive maintenance failed: {e}")
+            report = {"started_at": datetime.now().isoformat(), "errors": [str(e)]}
+            with self.lock:
+                self.reports.append(report)
+            return report
+
+    def loop(self):
+        """Run a pass whenever the server has been idle long enough and the last pass was long enough ago"""
+        while True:
+            time.sleep(30)
+            settings = self.settings
+            if not settings.get('enabled', False) or not automation.is_browser_ready() or not automation.is_authenticated:
+                continue
+            if self.last_run is not None and time.monotonic() - self.last_run < settings.get('interval', 3600):
+                continue
+            idle = automation_pipeline.idle_for()
+            if idle is None or idle < settings.get('idle_seconds', 300):
+                continue
+            self.run_now()
+
+    def snapshot(self):
+        with self.lock:
+            return {"enabled": self.settings.get('enabled', False), "reports": list(self.reports)}
+
+drive_maintenance = DriveMaintenance()
+
+@app.route('/admin/drive-maintenance', methods=['GET'])
+def drive_maintenance_reports():
+    """Recent maintenance passes, with folder load times before and after each"""
+    return jsonify(drive_maintenance.snapshot())
+
+@app.route('/admin/drive-maintenance', methods=['POST'])
+def run_drive_maintenance():
+    """Run a maintenance pass now, waiting behind any requests in the queue"""
+    return jsonify(drive_maintenance.run_now())
+
+# --- Hot Config Reload ---
+# Settings that only apply to a newly launched browser
+BROWSER_RESTART_SETTINGS = ('headless_mode', 'data_dir')
+# Settings that only apply when the server starts
+SERVER_RESTART_SETTINGS = ('host', 'port', 'secret_key')
+
+config_reload_lock = threading.Lock()
+config_mtime = None
+
+async def recycle_browser(previous_browser_settings):
+    """Relaunch the browser with the current settings. Waits its turn in the request queue,
+    so requests are held (not dropped) while the browser restarts. If the new settings don't
+    give a working, logged in browser, the previous settings are put back."""
+    async with automation_pipeline.exclusive():
+        logging.info("Recycling browser to apply new browser settings...")
+        await automation.close()
+        try:
+            await automation.initialize_browser()
+            if not automation.is_authenticated:
+                raise RuntimeError("the new browser is not logged in to Google")
+        except Exception as e:
+            logging.error(f"Browser failed to start with the new settings ({e}), going back to the previous ones")
+            with config_reload_lock:
+                apply_config(dict(config, browser=previous_browser_settings))
+            with contextlib.suppress(Exception):
+                await automation.close()
+            await automation.initialize_browser()
+            logging.info("Browser restarted with the previous settings")
+            return
+        logging.info("Browser recycled")
+
+def log_recycle_failure(future):
+    """Done callback for recycle_browser, which otherwise fails without a trace"""
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"Browser could not be restarted, restart the server: {future.exception()!r}")
+
+def reload_config():
+    """Validate config.json and atomically swap it in. Returns what changed, raises ConfigError if invalid."""
+    global config_mtime
+    with config_reload_lock:
+        config_path = get_config_path()
+        config_mtime = os.path.getmtime(config_path)
+        new_config = read_config(config_path)
+        old_config = config
+
+        changed_sections = sorted(section for section in set(old_config) | set(new_config)
+                                  if old_config.get(section) != new_config.get(section))
+        if not changed_sections:
+            return {"changed": [], "browser_recycle": False}
+
+        restart_needed = [key for key in SERVER_RESTART_SETTINGS if old_config['server'][key] != new_config['server'][key]]
+        if restart_needed:
+            logging.warning(f"Config changes to server.{', server.'.join(restart_needed)} apply after a restart")
+
+        # Requests in flight were given slots by position, so the number of slots can't change under them
+        slot_count = len(new_config.get('pipeline', {}).get('extra_slots', [])) + 1
+        if slot_count != automation_pipeline.slot_count:
+            raise ConfigError(f"Changing the number of pipeline slots ({automation_pipeline.slot_count} -> {slot_count}) "
+                              "needs a restart, keeping the current config")
+
+        recycle = any(old_config['browser'][key] != new_config['browser'][key] for key in BROWSER_RESTART_SETTINGS)
+        apply_config(new_config)
+        logging.info(f"Reloaded config.json (changed: {', '.join(changed_sections)})")
+
+        if recycle:
+            recycle_future = asyncio.run_coroutine_threadsafe(recycle_browser(old_config['browser']), automation_runner.loop)
+            recycle_future.add_done_callback(log_recycle_failure)
+        return {"changed": changed_sections, "browser_recycle": recycle, "restart_needed": restart_needed}
+
+def watch_config_file():
+    """Reload config.json whenever it changes on disk"""
+    global config_mtime
+    config_path = get_config_path()
+    config_mtime = os.path.getmtime(config_path)
+    while True:
+        time.sleep(config.get('config_reload', {}).get('interval', 2))
+        try:
+            if os.path.getmtime(config_path) == config_mtime:
+                continue
+            reload_config()
+        except ConfigError as e:
+            logging.error(f"Keeping the current config: {e}")
+        except OSError as e:
+            logging.warning(f"Could not check config.json for changes: {e}")
+
+@app.route('/admin/reload-config', methods=['POST'])
+def admin_reload_config():
+    try:
+        result = reload_config()
+    except ConfigError as e:
+        return jsonify({"error": {"message": str(e), "type": "invalid_request_error", "code": "invalid_config"}}), 400
+    return jsonify(result)
+
 async def setup_automation():
     """Initialize browser automation for the server."""
     global automation
@@ -831,10 +2912,14 @@ if __name__ == '__main__':
                 print(f"Error closing browser: {e}")
         
         automation_runner.stop_loop()
+        stage_stats.flush()
         print("Shutdown complete.")
     
     atexit.register(shutdown_server)
 
+    if config.get('config_reload', {}).get('watch_file', True):
+        threading.Thread(target=watch_config_file, daemon=True).start()
+
     print("="*60)
     print("   AI Studio Automated API Server - OpenAI Compatible")
     print("="*60)
@@ -846,6 +2931,10 @@ if __name__ == '__main__':
     # Run setup to initialize browser and check for authentication
     print("\nInitializing browser and checking authentication...")
     automation_runner.run_coroutine(setup_automation())
+
+    # Carry on with batches a previous run didn't finish
+    batch_manager.start()
+    threading.Thread(target=drive_maintenance.loop, daemon=True).start()
     
     print(f"\nServer starting at http://{HOST}:{PORT}")
     print("="*60)
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+Gateway that spreads /v1/chat/completions requests across several api_server.py instances,
+each running on its own machine with its own logged in browser.
+
+Backends are listed in the "gateway" section of config.json. The gateway health checks them,
+sends each request to the backend with the shortest queue and lowest recent latency, and fails
+over to the next backend when one can't take the request.
+"""
+import flask
+from flask import request, jsonify, Response
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import logging
+
+# --- Configuration Loading ---
+def load_config():
+    """Load configuration from config.json file"""
+    if getattr(sys, 'frozen', False):
+        config_path = os.path.join(os.path.dirname(sys.executable), 'config.json')
+    else:
+        config_path = os.path.join(os.path.dirname(__file__), 'config.json')
+
+    try:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        print(f"Error: config.json not found at {config_path}")
+        exit(1)
+    except json.JSONDecodeError as e:
+        print(f"Error: Invalid JSON in config.json: {e}")
+        exit(1)
+
+config = load_config()
+GATEWAY_CONFIG = config.get('gateway', {})
+
+HOST = GATEWAY_CONFIG.get('host', '127.0.0.1')
+PORT = GATEWAY_CONFIG.get('port', 8384)
+HEALTH_CHECK_INTERVAL = GATEWAY_CONFIG.get('health_check_interval', 10)  # seconds
+REQUEST_TIMEOUT = GATEWAY_CONFIG.get('request_timeout', 1800)  # seconds
+FAILOVER_COOLDOWN = GATEWAY_CONFIG.get('failover_cooldown', 60)  # seconds
+
+# Headers passed from the client to the backend and back
+FORWARDED_REQUEST_HEADERS = ('Content-Type', 'Accept', 'Accept-Encoding', 'Authorization', 'X-Request-Timeout')
+FORWARDED_RESPONSE_HEADERS = ('Content-Type', 'Content-Encoding', 'Retry-After', 'Cache-Control', 'X-Accel-Buffering')
+
+# Backend error codes that mean another backend may still succeed
+FAILOVER_ERROR_CODES = ('automation_failed', 'rate_limit_exceeded')
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+app = flask.Flask(__name__)
+
+# --- Backends ---
+class Backend:
+    """One api_server.py instance and what the gateway knows about its load"""
+    def __init__(self, url, smoothing=0.3):
+        self.url = url.rstrip('/')
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        self.healthy = True  # Assume healthy until the first check says otherwise
+        self.queue_depth = 0  # As reported by the backend's /health
+        self.in_flight = 0  # Requests this gateway has sent and not finished
+        self.latency = None
+        self.last_error = None
+        self.cooldown_until = 0  # Backends that just failed a request are tried last until then
+
+    def cooling_down(self):
+        with self.lock:
+            return time.monotonic() < self.cooldown_until
+
+    def score(self):
+        """Expected wait on this backend, lower is better"""
+        with self.lock:
+            latency = self.latency if self.latency is not None else 60
+            return (max(self.queue_depth, self.in_flight) + 1) * latency
+
+    def check_health(self):
+        try:
+            with urllib.request.urlopen(f"{self.url}/health", timeout=5) as response:
+                payload = json.loads(response.read())
+            with self.lock:
+                self.healthy = True
+                self.queue_depth = payload.get('queue_depth', 0)
+                if payload.get('recent_latency') is not None:
+                    self.latency = payload['recent_latency']
+                self.last_error = None
+        except urllib.error.HTTPError as e:
+            self.mark_unhealthy(f"Health check returned {e.code}")
+        except Exception as e:
+            self.mark_unhealthy(f"Health check failed: {e}")
+
+    def mark_unhealthy(self, reason):
+        with self.lock:
+            if self.healthy:
+                logging.warning(f"Backend {self.url} is unhealthy: {reason}")
+            self.healthy = False
+            self.last_error = reason
+
+    def record_failure(self, reason):
+        """The backend answered but failed the request (e.g. automation_failed). Its health check still
+        passes, so it is ranked after the other backends for a while instead of being marked unhealthy."""
+        with self.lock:
+            self.cooldown_until = time.monotonic() + FAILOVER_COOLDOWN
+            self.last_error = reason
+
+    def start_request(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def finish_request(self, seconds=None):
+        with self.lock:
+            self.in_flight -= 1
+            if seconds is not None:
+                if self.latency is None:
+                    self.latency = seconds
+                else:
+                    self.latency += self.smoothing * (seconds - self.latency)
+
+    def snapshot(self):
+        with self.lock:
+            return {"url": self.url, "healthy": self.healthy, "queue_depth": self.queue_depth,
+                    "in_flight": self.in_flight, "recent_latency": self.latency, "last_error": self.last_error,
+                    "cooling_down": time.monotonic() < self.cooldown_until}
+
+backends = [Backend(url) for url in GATEWAY_CONFIG.get('backends', [])]
+
+def health_check_loop():
+    while True:
+        for backend in backends:
+            backend.check_health()
+        time.sleep(HEALTH_CHECK_INTERVAL)
+
+def ranked_backends():
+    """Healthy backends first and ones that just failed a request after those, each group ordered by expected wait"""
+    return sorted(backends, key=lambda backend: (not backend.healthy, backend.cooling_down(), backend.score()))
+
+# --- Proxying ---
+def is_failover_error(status, body):
+    """Check if a backend's error response means the request should be tried on another backend"""
+    if status in (429, 502, 503):
+        # 429 means that backend's Google account hit its quota, another account may still have some left
+        return True
+    if status == 500:
+        try:
+            error = json.loads(body).get('error', {})
+        except (ValueError, AttributeError):
+            return False
+        return isinstance(error, dict) and error.get('code') in FAILOVER_ERROR_CODES
+    return False
+
+class BackendError(Exception):
+    """No backend took the request, carries the response to give the client instead"""
+    def __init__(self, status, headers, body):
+        super().__init__(f"Backend error {status}")
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+def open_backend(candidates, body, headers):
+    """Send the request to each candidate in turn (removing it from the list) until one takes it.
+    Returns (backend, response, start time), or raises BackendError with the response for the client."""
+    last_error = None
+    while candidates:
+        backend = candidates.pop(0)
+        backend_request = urllib.request.Request(f"{backend.url}/v1/chat/completions", data=body, headers=headers, method='POST')
+        backend.start_request()
+        started = time.monotonic()
+        try:
+            return backend, urllib.request.urlopen(backend_request, timeout=REQUEST_TIMEOUT), started
+        except urllib.error.HTTPError as e:
+            error_body = e.read()
+            backend.finish_request()
+            if is_failover_error(e.code, error_body):
+                logging.warning(f"Backend {backend.url} failed the request ({e.code}), failing over")
+                last_error = f"{backend.url} returned {e.code}"
+                backend.record_failure(f"Request failed with {e.code}")
+                continue
+            # Client errors and timeouts are returned as they are
+            raise BackendError(e.code, e.headers, error_body)
+        except Exception as e:
+            backend.finish_request()
+            backend.mark_unhealthy(str(e))
+            logging.warning(f"Backend {backend.url} unreachable ({e}), failing over")
+            last_error = f"{backend.url} unreachable: {e}"
+            continue
+
+    error = {"error": {
+        "message": f"No backend could handle the request. Last error: {last_error}",
+        "type": "server_error",
+        "code": "automation_failed"
+    }}
+    raise BackendError(503, {'Content-Type': 'application/json'}, json.dumps(error).encode('utf-8'))
+
+def stream_backend_response(backend, backend_response, started):
+    """Pass the backend's body to the client as it arrives, without buffering it"""
+    try:
+        while True:
+            data = backend_response.read1(8192)
+            if not data:
+                break
+            yield data
+    finally:
+        backend_response.close()
+        backend.finish_request(time.monotonic() - started)
+
+def sse_events(backend_response):
+    """Split a backend's SSE stream into events, each with its trailing blank line"""
+    event = []
+    for line in iter(backend_response.readline, b''):
+        event.append(line)
+        if line in (b'\n', b'\r\n'):
+            yield b''.join(event)
+            event = []
+    if event:
+        yield b''.join(event)
+
+def sse_data(event):
+    """Parsed JSON payload of an SSE event, or None for comments, [DONE] and anything else"""
+    for line in event.splitlines():
+        if line.startswith(b'data: {'):
+            try:
+                return json.loads(line[len(b'data: '):])
+            except ValueError:
+                return None
+    return None
+
+def stream_with_failover(backend, backend_response, started, candidates, body, headers):
+    """Pass a streamed completion through, moving on to the next backend if one fails before any content.
+
+    Backends start streaming (with a 200) before AI Studio runs, so a failed request only shows up as an
+    error event in the stream. The client already has the role chunk and keepalives by then, so the next
+    backend's role chunk is dropped and its stream continues the same response."""
+    sent_role = False
+    while True:
+        failed_code = None
+        try:
+            for event in sse_events(backend_response):
+                data = sse_data(event)
+                error = data.get('error') if isinstance(data, dict) else None
+                if isinstance(error, dict) and error.get('code') in FAILOVER_ERROR_CODES and candidates:
+                    failed_code = error.get('code')
+                    break
+                if isinstance(data, dict) and [choice.get('delta') for choice in data.get('choices', [])] == [{"role": "assistant"}]:
+                    if sent_role:
+                        continue
+                    sent_role = True
+                yield event
+        finally:
+            backend_response.close()
+            backend.finish_request(None if failed_code else time.monotonic() - started)
+        if failed_code is None:
+            return
+
+        logging.warning(f"Backend {backend.url} failed a streamed request ({failed_code}), failing over")
+        backend.record_failure(f"Streamed request failed with {failed_code}")
+        try:
+            backend, backend_response, started = open_backend(candidates, body, headers)
+        except BackendError as e:
+            try:
+                error = json.loads(e.body)['error']
+            except (ValueError, KeyError, TypeError):
+                error = {"message": f"Backend error {e.status}", "type": "server_error", "code": "automation_failed"}
+            yield f"data: {json.dumps({'error': error})}\n\n".encode('utf-8')
+            yield b"data: [DONE]\n\n"
+            return
+        logging.info(f"Routed streamed request to {backend.url}")
+
+def build_response(status, backend_headers, body):
+    headers = {name: backend_headers[name] for name in FORWARDED_RESPONSE_HEADERS if name in backend_headers}
+    return Response(body, status=status, headers=headers, direct_passthrough=True)
+
+@app.route('/v1/chat/completions', methods=['POST'])
+def chat_completions():
+    body = request.get_data()
+    headers = {name: request.headers[name] for name in FORWARDED_REQUEST_HEADERS if name in request.headers}
+    candidates = ranked_backends()
+    try:
+        backend, backend_response, started = open_backend(candidates, body, headers)
+    except BackendError as e:
+        return build_response(e.status, e.headers, e.body)
+
+    logging.info(f"Routed request to {backend.url}")
+    if backend_response.headers.get('Content-Type', '').startswith('text/event-stream'):
+        stream = stream_with_failover(backend, backend_response, started, candidates, body, headers)
+    else:
+        stream = stream_backend_response(backend, backend_response, started)
+    return build_response(backend_response.status, backend_response.headers, stream)
+
+@app.route('/health', methods=['GET'])
+def health():
+    states = [backend.snapshot() for backend in backends]
+    healthy = [state for state in states if state['healthy']]
+    payload = {
+        "status": "ok" if healthy else "unavailable",
+        "queue_depth": sum(state['queue_depth'] for state in healthy),
+        "backends": states
+    }
+    return jsonify(payload), 200 if healthy else 503
+
+
+if __name__ == '__main__':
+    if not backends:
+        print("Error: no backends configured. Add their URLs to \"gateway\": {\"backends\": [...]} in config.json.")
+        exit(1)
+
+    print("="*60)
+    print("   AI Studio API Gateway - OpenAI Compatible")
+    print("="*60)
+    for backend in backends:
+        print(f"Backend: {backend.url}")
+
+    threading.Thread(target=health_check_loop, daemon=True).start()
+
+    print(f"\nGateway starting at http://{HOST}:{PORT}")
+    print("="*60)
+
+    app.run(host=HOST, port=PORT, threaded=True)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Replay recorded /v1/chat/completions traffic against a running server and report latencies.
+
+Record traffic first by setting "recording": {"enabled": true} in config.json, then run:
+    python replay_traffic.py requests.jsonl --speed 1       # original rate
+    python replay_traffic.py requests.jsonl --speed 4       # 4x faster than recorded
+    python replay_traffic.py requests.jsonl --max-rate      # as fast as the server takes them
+"""
+import argparse
+import json
+import queue
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+def load_records(path):
+    """Load recorded requests, skipping lines that aren't recorded traffic"""
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping line {line_number}: invalid JSON")
+                continue
+            if not isinstance(entry, dict) or not isinstance(entry.get('request'), dict):
+                continue
+            records.append(entry)
+    records.sort(key=lambda entry: entry.get('arrival', 0))
+    return records
+
+def stream_error(body):
+    """The error event of a streamed response, if it has one. Streams that fail after the 200 was sent end with one."""
+    for line in body.splitlines():
+        if line.startswith(b'data: {'):
+            try:
+                event = json.loads(line[len(b'data: '):])
+            except json.JSONDecodeError:
+                continue
+            if isinstance(event.get('error'), dict):
+                return event['error']
+    return None
+
+def error_code(body):
+    """The OpenAI style error code in a JSON error response, if there is one"""
+    try:
+        error = json.loads(body).get('error')
+    except (json.JSONDecodeError, AttributeError):
+        return None
+    return error.get('code') if isinstance(error, dict) else None
+
+def send_request(url, entry, timeout):
+    """Send one recorded request and return its result (status, latency, time to first byte, error)"""
+    body = json.dumps(entry['request']).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+    headers.update(entry.get('headers', {}))
+    http_request = urllib.request.Request(url, data=body, headers=headers, method='POST')
+
+    start = time.monotonic()
+    result = {"status": None, "latency": None, "first_byte": None, "error": None, "error_code": None,
+              "recorded_status": entry.get('status'), "recorded_latency": entry.get('timings', {}).get('total')}
+    try:
+        with urllib.request.urlopen(http_request, timeout=timeout) as response:
+            result["status"] = response.status
+            first = response.read(1)
+            result["first_byte"] = time.monotonic() - start
+            body = first + response.read()
+            if response.headers.get_content_type() == 'text/event-stream':
+                error = stream_error(body)
+                if error is not None:
+                    result["error"] = str(error.get('message'))[:200]
+                    result["error_code"] = error.get('code')
+    except urllib.error.HTTPError as e:
+        result["status"] = e.code
+        body = e.read()
+        result["error"] = body.decode('utf-8', errors='replace')[:200]
+        result["error_code"] = error_code(body)
+    except Exception as e:
+        result["error"] = str(e)
+    result["latency"] = time.monotonic() - start
+    return result
+
+def replay_timed(url, records, speed, timeout):
+    """Send each request at its recorded offset from the first one, divided by speed"""
+    results = []
+    results_lock = threading.Lock()
+
+    def worker(entry):
+        result = send_request(url, entry, timeout)
+        with results_lock:
+            results.append(result)
+
+    threads = []
+    first_arrival = records[0].get('arrival', 0)
+    replay_start = time.monotonic()
+    for entry in records:
+        offset = (entry.get('arrival', first_arrival) - first_arrival) / speed
+        delay = replay_start + offset - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        thread = threading.Thread(target=worker, args=(entry,), daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
+
+def replay_max_rate(url, records, concurrency, timeout):
+    """Send requests back to back from a fixed number of workers"""
+    pending = queue.Queue()
+    for entry in records:
+        pending.put(entry)
+    results = []
+    results_lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                entry = pending.get_nowait()
+            except queue.Empty:
+                return
+            result = send_request(url, entry, timeout)
+            with results_lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(results, elapsed):
+    """Latency distribution and error counts for a replay"""
+    def distribution(values):
+        return {
+            "min": min(values) if values else None,
+            "p50": percentile(values, 0.50),
+            "p90": percentile(values, 0.90),
+            "p99": percentile(values, 0.99),
+            "max": max(values) if values else None,
+            "mean": sum(values) / len(values) if values else None
+        }
+
+    ok = []
+    errors = {}
+    for r in results:
+        if r["status"] == 200 and r["error"] is None:
+            ok.append(r)
+        else:
+            key = str(r["status"]) if r["status"] is not None else "connection_error"
+            if r.get("error_code"):
+                key = f"{key} {r['error_code']}"
+            errors[key] = errors.get(key, 0) + 1
+    recorded = [r["recorded_latency"] for r in results if r["recorded_latency"] is not None]
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "errors": errors,
+        "elapsed_seconds": elapsed,
+        "throughput_per_minute": len(results) / elapsed * 60 if elapsed > 0 else None,
+        "latency": distribution([r["latency"] for r in ok]),
+        "first_byte": distribution([r["first_byte"] for r in ok if r["first_byte"] is not None]),
+        "recorded_latency": distribution(recorded)
+    }
+
+def print_report(report):
+    print("="*60)
+    print(f"Requests: {report['requests']}  Succeeded: {report['succeeded']}  Elapsed: {report['elapsed_seconds']:.1f}s")
+    if report['errors']:
+        print(f"Errors: {', '.join(f'{status} x{count}' for status, count in report['errors'].items())}")
+    for name in ('latency', 'first_byte', 'recorded_latency'):
+        values = report[name]
+        if values['min'] is None:
+            continue
+        print(f"{name:>17}: " + "  ".join(f"{key}={value:.2f}s" for key, value in values.items()))
+    print("="*60)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded chat completion traffic against the server")
+    parser.add_argument('file', nargs='?', default='requests.jsonl', help="Recorded traffic (JSONL)")
+    parser.add_argument('--base-url', default='http://127.0.0.1:8383', help="Server to replay against")
+    parser.add_argument('--speed', type=float, default=1.0, help="Replay speed relative to the recorded rate")
+    parser.add_argument('--max-rate', action='store_true', help="Ignore recorded timing and send as fast as possible")
+    parser.add_argument('--concurrency', type=int, default=4, help="Workers used with --max-rate")
+    parser.add_argument('--limit', type=int, help="Only replay the first N requests")
+    parser.add_argument('--timeout', type=float, default=1800, help="Per request timeout (seconds)")
+    parser.add_argument('--report', help="Also write the report as JSON to this file")
+    args = parser.parse_args()
+
+    records = load_records(args.file)
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        print(f"No recorded requests found in {args.file}")
+        return 1
+    if args.speed <= 0:
+        print("--speed must be positive")
+        return 1
+
+    url = args.base_url.rstrip('/') + '/v1/chat/completions'
+    mode = f"max rate, {args.concurrency} workers" if args.max_rate else f"{args.speed}x recorded rate"
+    print(f"Replaying {len(records)} requests against {url} ({mode})...")
+
+    start = time.monotonic()
+    if args.max_rate:
+        results = replay_max_rate(url, records, args.concurrency, args.timeout)
+    else:
+        results = replay_timed(url, records, args.speed, args.timeout)
+    report = summarize(results, time.monotonic() - start)
+
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.report}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
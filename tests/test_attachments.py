@@ -0,0 +1,43 @@
+"""Image parts and how they interact with the similarity cache (user-038)"""
+import base64
+
+import pytest
+
+import api_server
+from api_server import AttachmentError, SimilarityCache, transform_to_gemini_format
+
+
+def image_request(image_bytes, question="What is in this image?"):
+    data_url = "data:image/png;base64," + base64.b64encode(image_bytes).decode('ascii')
+    return {"messages": [{"role": "user", "content": [
+        {"type": "text", "text": question},
+        {"type": "image_url", "image_url": {"url": data_url}}
+    ]}]}
+
+
+def test_image_parts_become_chunks_before_the_text():
+    chunks = transform_to_gemini_format(image_request(b"image a"))["chunkedPrompt"]["chunks"]
+    assert chunks[0]["inlineImage"] == {"mimeType": "image/png", "data": base64.b64encode(b"image a").decode('ascii')}
+    assert chunks[1] == {"role": "user", "text": "What is in this image?"}
+
+
+def test_similarity_cache_tells_different_images_apart(monkeypatch):
+    monkeypatch.setitem(api_server.config, 'similarity_cache', {"enabled": True})
+    cache = SimilarityCache()
+    cache.store(cache.fingerprint(transform_to_gemini_format(image_request(b"image a"))), "a cat")
+
+    assert cache.lookup(cache.fingerprint(transform_to_gemini_format(image_request(b"image b")))) is None
+    content, similarity = cache.lookup(cache.fingerprint(transform_to_gemini_format(image_request(b"image a"))))
+    assert content == "a cat"
+
+
+def test_local_files_are_off_by_default(monkeypatch, tmp_path):
+    monkeypatch.setitem(api_server.config, 'attachments', {})
+    image_path = tmp_path / "image.png"
+    image_path.write_bytes(b"image")
+    part = {"type": "image_url", "image_url": {"url": str(image_path)}}
+    with pytest.raises(AttachmentError, match="disabled"):
+        api_server.load_image(part)
+
+    monkeypatch.setitem(api_server.config, 'attachments', {"allow_local_files": True})
+    assert api_server.load_image(part) == (b"image", "image/png")
@@ -0,0 +1,88 @@
+"""Batch processing: duplicates, resuming and quota handling (user-037)"""
+import json
+import time
+
+import pytest
+
+import api_server
+from api_server import BatchManager, QuotaExceeded
+
+
+def chat_line(custom_id, text):
+    return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+            "body": {"messages": [{"role": "user", "content": text}]}}
+
+
+@pytest.fixture
+def manager(monkeypatch, tmp_path):
+    monkeypatch.setitem(api_server.config, 'batches', {"directory": str(tmp_path / "batches")})
+    monkeypatch.setitem(api_server.config, 'circuit_breaker', {"enabled": False})
+    return BatchManager()
+
+
+def create_batch(manager, texts):
+    lines = [chat_line(f"request-{i}", text) for i, text in enumerate(texts)]
+    input_file = manager.create_file("\n".join(json.dumps(line) for line in lines).encode('utf-8'), "input.jsonl", "batch")
+    batch = manager.create_batch(input_file["id"], "/v1/chat/completions", None)
+    manager.queue.get()
+    return batch["id"]
+
+
+def read_lines(manager, file_id):
+    with open(manager.file_path(file_id), 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def fake_automation(monkeypatch, answer):
+    prompts = []
+
+    async def process(transformed_data, deadline=None, timings=None):
+        prompts.append(transformed_data["chunkedPrompt"]["chunks"][-1]["text"])
+        return answer(prompts[-1], len(prompts))
+
+    monkeypatch.setattr(api_server, 'process_request_with_automation', process)
+    return prompts
+
+
+def test_duplicates_run_once_and_resume_skips_finished_items(manager, monkeypatch):
+    prompts = fake_automation(monkeypatch, lambda text, calls: f"answer to {text}")
+    batch_id = create_batch(manager, ["a", "b", "a", "c"])
+
+    manager.process(batch_id)
+    batch = manager.get_batch(batch_id)
+    assert batch["status"] == "completed"
+    assert batch["request_counts"] == {"total": 4, "completed": 4, "failed": 0}
+    assert batch["skipped"]["duplicates"] == 1
+    assert sorted(prompts) == ["a", "b", "c"]
+    output = {line["custom_id"]: line["response"]["body"]["choices"][0]["message"]["content"]
+              for line in read_lines(manager, batch["output_file_id"])}
+    assert output == {"request-0": "answer to a", "request-1": "answer to b",
+                      "request-2": "answer to a", "request-3": "answer to c"}
+
+    # Pretend the server stopped before the batch was marked done, it should not run anything again
+    manager.update(batch_id, status='in_progress')
+    prompts.clear()
+    manager.process(batch_id)
+    batch = manager.get_batch(batch_id)
+    assert prompts == []
+    assert batch["request_counts"]["completed"] == 4
+    assert batch["skipped"]["duplicates"] == 1
+
+
+def test_quota_errors_back_off_and_give_up_without_the_circuit_breaker(manager, monkeypatch):
+    monkeypatch.setitem(api_server.config['batches'], 'max_quota_retries', 3)
+
+    def answer(text, calls):
+        raise QuotaExceeded("quota reached", retry_after=0.2)
+
+    prompts = fake_automation(monkeypatch, answer)
+    batch_id = create_batch(manager, ["a"])
+
+    started = time.monotonic()
+    manager.process(batch_id)
+    batch = manager.get_batch(batch_id)
+    assert len(prompts) == 3
+    # Waited out the pause after each of the first two quota errors instead of retrying straight away
+    assert time.monotonic() - started >= 0.4
+    assert batch["request_counts"] == {"total": 1, "completed": 0, "failed": 1}
+    assert read_lines(manager, batch["error_file_id"])[0]["error"]["code"] == "rate_limit_exceeded"
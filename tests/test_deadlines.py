@@ -0,0 +1,23 @@
+"""Request deadlines (user-026)"""
+import pytest
+
+from api_server import app, get_request_deadline
+
+
+@pytest.mark.parametrize("timeout", ["nan", "inf", "-inf", 0, -5, "soon"])
+def test_invalid_timeouts_are_rejected(timeout):
+    with app.test_request_context('/v1/chat/completions', method='POST'):
+        with pytest.raises(ValueError):
+            get_request_deadline({"timeout": timeout})
+
+
+def test_header_takes_precedence_over_the_body():
+    with app.test_request_context('/v1/chat/completions', method='POST', headers={'X-Request-Timeout': '30'}):
+        deadline = get_request_deadline({"timeout": 600})
+    assert deadline.seconds == 30
+
+
+def test_nan_timeout_gets_a_400():
+    response = app.test_client().post('/v1/chat/completions', json={"messages": [], "timeout": "nan"})
+    assert response.status_code == 400
+    assert response.get_json()["error"]["code"] == "invalid_timeout"
@@ -0,0 +1,52 @@
+"""Which Drive files maintenance may delete (user-039)"""
+import time
+
+import pytest
+
+import api_server
+from api_server import DriveMaintenance
+
+PROMPT_URL = "https://aistudio.google.com/prompts/"
+
+
+@pytest.fixture
+def slots(monkeypatch):
+    def use(*slots):
+        monkeypatch.setattr(api_server, 'get_slots', lambda: [
+            {"transformed_request_file": name, "aistudio_url": url} for name, url in slots])
+    return use
+
+
+def ids(files):
+    return [file["id"] for file in files]
+
+
+def test_the_prompt_file_is_kept_even_when_named_like_a_copy(slots):
+    slots(("CodeRequest", PROMPT_URL + "ID_OF_COPY"))
+    files = [{"id": "ID_ORIG", "name": "CodeRequest"}, {"id": "ID_OF_COPY", "name": "CodeRequest (1)"}]
+    prompts, duplicates, attachments = DriveMaintenance().classify(files)
+    assert ids(prompts) == ["ID_OF_COPY"]
+    assert ids(duplicates) == ["ID_ORIG"]
+
+
+def test_no_deduplication_without_the_prompt_in_the_listing(slots):
+    slots(("CodeRequest", PROMPT_URL + "NOT_LISTED"), ("CodeRequest2", "https://aistudio.google.com/app/u/0"))
+    files = [{"id": "A", "name": "CodeRequest"}, {"id": "B", "name": "CodeRequest (1)"},
+             {"id": "C", "name": "CodeRequest2"}, {"id": "D", "name": "CodeRequest2 (3)"}]
+    prompts, duplicates, attachments = DriveMaintenance().classify(files)
+    assert duplicates == []
+    assert prompts == []
+
+
+def test_only_registered_attachments_are_trashed(monkeypatch):
+    monkeypatch.setitem(api_server.config, 'drive_maintenance', {"max_files": 1, "attachment_max_age_days": 7})
+    uploaded = {"old": time.time() - 8 * 24 * 3600, "new": time.time()}
+    monkeypatch.setattr(api_server.attachment_registry, 'uploaded_at', uploaded.get)
+    attachments = [{"id": file_id, "name": "0" * 32 + ".png"} for file_id in ("someone_elses", "new", "old")]
+    to_trash = DriveMaintenance().attachments_to_trash(attachments, file_count=3)
+    assert ids(to_trash) == ["old", "new"]
+
+
+def test_maintenance_is_off_by_default(monkeypatch):
+    monkeypatch.setitem(api_server.config, 'drive_maintenance', {})
+    assert DriveMaintenance().snapshot()["enabled"] is False
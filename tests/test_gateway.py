@@ -0,0 +1,25 @@
+"""Gateway routing (user-030)"""
+import gateway
+from gateway import Backend
+
+
+def test_failed_backend_is_ranked_last_during_its_cooldown(monkeypatch):
+    fast, slow = Backend("http://fast"), Backend("http://slow")
+    fast.latency, slow.latency = 5, 50
+    monkeypatch.setattr(gateway, 'backends', [slow, fast])
+    assert gateway.ranked_backends() == [fast, slow]
+
+    fast.record_failure("Request failed with 500")
+    assert gateway.ranked_backends() == [slow, fast]
+    assert fast.snapshot()["cooling_down"]
+
+    fast.cooldown_until = 0
+    assert gateway.ranked_backends() == [fast, slow]
+
+
+def test_cooling_down_backend_is_still_preferred_over_an_unhealthy_one(monkeypatch):
+    failed, down = Backend("http://failed"), Backend("http://down")
+    failed.record_failure("Request failed with 500")
+    down.mark_unhealthy("unreachable")
+    monkeypatch.setattr(gateway, 'backends', [down, failed])
+    assert gateway.ranked_backends() == [failed, down]
@@ -0,0 +1,193 @@
+"""Ordering invariants of the automation pipeline (user-033)"""
+import asyncio
+import copy
+
+import pytest
+
+import api_server
+from api_server import AutomationPipeline, ConfigError, Deadline, Turnstile
+
+
+def run(coro, timeout=5):
+    # A hang in the pipeline shows up as a timeout instead of a stuck test run
+    async def with_timeout():
+        return await asyncio.wait_for(coro, timeout)
+    return asyncio.run(with_timeout())
+
+
+async def fake_request(pipeline, ticket, events, upload_seconds=0.01, run_seconds=0.03):
+    """Goes through both stages like process_request_with_automation, recording what happens when"""
+    slot = ticket % pipeline.slot_count
+    await pipeline.wait_upload_turn(ticket, Deadline())
+    events.append(('upload_start', ticket, slot))
+    await asyncio.sleep(upload_seconds)
+    events.append(('upload_end', ticket, slot))
+    await pipeline.finish(ticket, 'upload')
+    await pipeline.wait_run_turn(ticket, Deadline())
+    events.append(('run_start', ticket, slot))
+    await asyncio.sleep(run_seconds)
+    events.append(('run_end', ticket, slot))
+    await pipeline.finish(ticket)
+
+
+def position(events, kind, ticket):
+    return events.index(next(event for event in events if event[0] == kind and event[1] == ticket))
+
+
+def test_turnstile_lets_tickets_through_in_order():
+    turnstile = Turnstile()
+    turnstile.done(0)
+    turnstile.done(1)
+    assert turnstile.turn == 2
+    turnstile.done(1)  # Finishing twice is harmless
+    assert turnstile.turn == 2
+
+
+def test_turnstile_skips_abandoned_tickets():
+    turnstile = Turnstile()
+    turnstile.done(2)
+    turnstile.done(1)
+    assert turnstile.turn == 0
+    turnstile.done(0)
+    assert turnstile.turn == 3
+    assert not turnstile.skipped
+
+
+def test_depth_counts_unfinished_tickets():
+    pipeline = AutomationPipeline(2)
+    tickets = [pipeline.take_ticket() for _ in range(3)]
+    assert pipeline.depth() == 3
+    run(pipeline.finish(tickets[2]))
+    assert pipeline.depth() == 2
+    run(pipeline.finish(tickets[0]))
+    assert pipeline.depth() == 1
+    run(pipeline.finish(tickets[1]))
+    assert pipeline.depth() == 0
+
+
+@pytest.mark.parametrize("slot_count", [1, 2, 3])
+def test_no_slot_is_reused_before_its_run_finishes(slot_count):
+    pipeline = AutomationPipeline(slot_count)
+    events = []
+
+    async def main():
+        tickets = [pipeline.take_ticket() for _ in range(8)]
+        await asyncio.gather(*(fake_request(pipeline, ticket, events) for ticket in tickets))
+
+    run(main())
+    for ticket in range(slot_count, 8):
+        assert position(events, 'upload_start', ticket) > position(events, 'run_end', ticket - slot_count)
+    run_order = [event[1] for event in events if event[0] == 'run_start']
+    assert run_order == list(range(8))
+    upload_order = [event[1] for event in events if event[0] == 'upload_start']
+    assert upload_order == list(range(8))
+
+
+def test_spare_slot_uploads_during_the_previous_run():
+    pipeline = AutomationPipeline(2)
+    events = []
+
+    async def main():
+        tickets = [pipeline.take_ticket() for _ in range(2)]
+        await asyncio.gather(*(fake_request(pipeline, ticket, events) for ticket in tickets))
+
+    run(main())
+    assert position(events, 'upload_start', 1) < position(events, 'run_end', 0)
+
+
+def test_runs_never_overlap():
+    pipeline = AutomationPipeline(3)
+    events = []
+
+    async def main():
+        tickets = [pipeline.take_ticket() for _ in range(6)]
+        await asyncio.gather(*(fake_request(pipeline, ticket, events) for ticket in tickets))
+
+    run(main())
+    runs = [event for event in events if event[0] in ('run_start', 'run_end')]
+    assert all(runs[i][0] == 'run_start' and runs[i + 1] == ('run_end',) + runs[i][1:] for i in range(0, len(runs), 2))
+
+
+def test_abandoned_tickets_do_not_block_later_requests():
+    pipeline = AutomationPipeline(2)
+    events = []
+
+    async def main():
+        first, abandoned, last = (pipeline.take_ticket() for _ in range(3))
+        later = asyncio.ensure_future(fake_request(pipeline, last, events))
+        # The middle request gives up (e.g. its deadline passed) before the first one has even started
+        await pipeline.finish(abandoned)
+        await fake_request(pipeline, first, events)
+        await later
+
+    run(main())
+    assert [event[1] for event in events if event[0] == 'run_start'] == [0, 2]
+
+
+def test_exclusive_waits_for_earlier_requests_and_holds_later_ones():
+    pipeline = AutomationPipeline(2)
+    events = []
+
+    async def exclusive_work():
+        async with pipeline.exclusive():
+            events.append(('exclusive_start', None, None))
+            await asyncio.sleep(0.03)
+            events.append(('exclusive_end', None, None))
+
+    async def main():
+        before = pipeline.take_ticket()
+        tasks = [asyncio.ensure_future(fake_request(pipeline, before, events))]
+        tasks.append(asyncio.ensure_future(exclusive_work()))
+        await asyncio.sleep(0)
+        after = pipeline.take_ticket()
+        tasks.append(asyncio.ensure_future(fake_request(pipeline, after, events)))
+        await asyncio.gather(*tasks)
+
+    run(main())
+    kinds = [event[0] for event in events]
+    assert kinds.index('exclusive_start') > position(events, 'run_end', 0)
+    assert kinds.index('exclusive_end') < position(events, 'upload_start', 2)
+
+
+def test_ticket_is_finished_when_the_slot_lookup_fails(monkeypatch):
+    pipeline = AutomationPipeline(1)
+
+    def missing_slot(ticket):
+        raise IndexError("slot removed by a config reload")
+
+    monkeypatch.setattr(pipeline, 'slot_for', missing_slot)
+    monkeypatch.setattr(api_server, 'automation_pipeline', pipeline)
+
+    with pytest.raises(IndexError):
+        run(api_server.process_request_with_automation({}))
+    assert pipeline.upload.turn == 1
+    assert pipeline.run.turn == 1
+
+    # The next request isn't stuck behind the failed one
+    run(pipeline.wait_upload_turn(pipeline.take_ticket(), Deadline()))
+
+
+def test_extra_slots_are_validated():
+    new_config = copy.deepcopy(api_server.config)
+    new_config['pipeline'] = {"extra_slots": [{"transformed_request_file": "CodeRequest2"}]}
+    with pytest.raises(ConfigError, match="extra_slots"):
+        api_server.validate_config(new_config)
+
+    new_config['pipeline'] = {"extra_slots": [{"transformed_request_file": "CodeRequest2",
+                                               "aistudio_url": "https://aistudio.google.com/prompts/2"}]}
+    api_server.validate_config(new_config)
+
+
+def test_reload_rejects_a_different_slot_count(monkeypatch, tmp_path):
+    new_config = copy.deepcopy(api_server.config)
+    new_config['pipeline'] = {"extra_slots": [{"transformed_request_file": "CodeRequest2",
+                                               "aistudio_url": "https://aistudio.google.com/prompts/2"}]}
+    config_path = tmp_path / "config.json"
+    config_path.write_text(api_server.json.dumps(new_config))
+    monkeypatch.setattr(api_server, 'get_config_path', lambda: str(config_path))
+    monkeypatch.setattr(api_server, 'automation_pipeline', AutomationPipeline(1))
+    old_config = api_server.config
+
+    with pytest.raises(ConfigError, match="restart"):
+        api_server.reload_config()
+    assert api_server.config is old_config
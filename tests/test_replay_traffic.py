@@ -0,0 +1,21 @@
+"""Replay error classification (user-032)"""
+from replay_traffic import stream_error, summarize
+
+
+def test_stream_error_event_is_found():
+    body = (b'data: {"choices": [{"delta": {"role": "assistant"}}]}\n\n'
+            b'data: {"error": {"message": "boom", "code": "automation_failed"}}\n\n'
+            b'data: [DONE]\n\n')
+    assert stream_error(body)["code"] == "automation_failed"
+    assert stream_error(b'data: {"choices": []}\n\ndata: [DONE]\n\n') is None
+
+
+def test_failed_streams_are_not_counted_as_successes():
+    results = [
+        {"status": 200, "error": None, "error_code": None, "latency": 1.0, "first_byte": 0.1, "recorded_latency": None},
+        {"status": 200, "error": "boom", "error_code": "automation_failed", "latency": 2.0, "first_byte": 0.1,
+         "recorded_latency": None},
+    ]
+    report = summarize(results, 10)
+    assert report["succeeded"] == 1
+    assert report["errors"] == {"200 automation_failed": 1}
@@ -0,0 +1,22 @@
+"""Adaptive timeout statistics (user-027)"""
+import api_server
+from api_server import StageStats
+
+
+def test_nothing_is_recorded_while_disabled(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_server, 'ADAPTIVE_TIMEOUTS', {'enabled': False})
+    stats = StageStats(str(tmp_path / 'stats.json'), save_interval=0)
+    stats.record('run_start', 100, 2.0)
+    assert stats.snapshot() == {}
+    assert not (tmp_path / 'stats.json').exists()
+
+
+def test_saves_are_debounced_and_flushed(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_server, 'ADAPTIVE_TIMEOUTS', {'enabled': True})
+    path = tmp_path / 'stats.json'
+    stats = StageStats(str(path), save_interval=3600)
+    for _ in range(10):
+        stats.record('run_start', 100, 2.0)
+    assert not path.exists()
+    stats.flush()
+    assert StageStats(str(path)).snapshot()['small']['run_start']['count'] == 10